@@ -0,0 +1,40 @@
+"""
+Compares the legacy whole-track FFT embedding against the windowed STFT mode.
+
+    python -m cli.bench -d 30 -d 180 -d 360
+"""
+import time
+import tracemalloc
+from typing import Callable, List
+
+import click
+import numpy as np
+
+from src.utils import SAMPLE_RATE, fft_embedding, stft_embedding
+
+
+def measure(func: Callable[[np.ndarray], np.ndarray], sample: np.ndarray):
+    """Returns the wall time in seconds and the peak traced memory in MB"""
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(sample)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak / 2**20
+
+
+@click.command()
+@click.option("--durations", "-d", multiple=True, type=int, default=[30, 180, 360])
+def bench(durations: List[int]):
+    rng = np.random.default_rng(0)
+    click.echo(f"{'seconds':>8} {'mode':>5} {'time (s)':>9} {'peak (MB)':>10}")
+    for seconds in durations:
+        sample = rng.integers(-(2**15), 2**15, SAMPLE_RATE * seconds, dtype=np.int16)
+        for mode, func in (("fft", fft_embedding), ("stft", stft_embedding)):
+            elapsed, peak = measure(func, sample)
+            click.echo(f"{seconds:>8} {mode:>5} {elapsed:>9.3f} {peak:>10.1f}")
+
+
+if __name__ == "__main__":
+    bench()
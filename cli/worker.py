@@ -0,0 +1,59 @@
+"""
+Processes the background jobs enqueued through `/api/jobs`, outside the web workers.
+
+    python -m cli.worker --concurrency 4 --cpu-workers 2
+"""
+import asyncio
+import os
+
+import click
+
+from src.clients import http
+from src.crawls import crawls
+from src.jobs import Worker, jobs
+from src.queues import memory, upserts
+from src.utils import engine
+import src.tasks  # noqa: F401  # registers the job handlers
+
+
+async def serve(concurrency: int):
+    worker = Worker(jobs, concurrency=concurrency)
+    await http.startup()
+    try:
+        await worker.run()
+    finally:
+        await memory.close()  # hands its last turns to the upsert queue
+        await upserts.close()
+        await http.cleanup()
+        await jobs.close()
+        await crawls.close()
+        engine.shutdown()
+
+
+@click.command()
+@click.option(
+    "--concurrency",
+    "-c",
+    type=int,
+    default=int(os.environ.get("JOBS_CONCURRENCY", 4)),
+    help="Jobs run at the same time",
+)
+@click.option(
+    "--cpu-workers",
+    "-w",
+    type=int,
+    default=engine.max_workers,
+    help="Processes of the embedding pool",
+)
+def main(concurrency: int, cpu_workers: int):
+    engine.max_workers = cpu_workers
+    # Every running job may wait on the pool, it must not turn them away with a 503
+    engine.max_pending = max(engine.max_pending, concurrency * 2)
+    try:
+        asyncio.run(serve(concurrency))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
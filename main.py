@@ -1,17 +1,36 @@
 import asyncio
 import json
+import os
 
 import aiohttp_cors
 from aiofauna import *
 from aiofauna.llm import LLMStack
+from aiohttp.web import StreamResponse
+from aiohttp.web_exceptions import HTTPBadRequest, HTTPNotFound
+from aiohttp_sse import sse_response
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
 from pytube import YouTube
 
 from src.handlers import (audiotrack_feed_handler, audiotrack_handler,
-                          get_assets)
+                          audiotrack_stream_handler, bulk_ingest_handler,
+                          embedding_mode, get_assets, required)
+from src.cache import cache, responses
+from src.chat import chat_with_memory as chat_reply
+from src.chat import send_reply, sse_reply
+from src.clients import http
+from src.crawls import crawls
+from src.index import fallback, index
+from src.jobs import Worker, handlers, jobs
+from src.queues import memory, upserts
 from src.services import User, YoutubeClient, auth
-from src.utils import template
+from src.sessions import sessions
+from src.sockets import sockets
+from src.storage import LocalStorage, storage
+from src.prompts import prompts
+from src.utils import EMBEDDING_VERSIONS, engine
+from src.website import sitemap_pipeline
+import src.tasks  # noqa: F401  # registers the job handlers
 
 load_dotenv()
 
@@ -20,6 +39,43 @@ app = APIServer()
 yt = YoutubeClient()
 logger = setup_logging(__name__)
 
+
+worker = Worker(jobs, concurrency=int(os.environ.get("JOBS_CONCURRENCY", 2)))
+app.on_startup.append(http.startup)
+app.on_cleanup.append(http.cleanup)
+
+
+@app.on_event("startup")
+async def load_prompts(_):
+    await asyncio.get_running_loop().run_in_executor(None, prompts.load)
+
+
+@app.on_event("startup")
+async def bootstrap_index(_):
+    # In the background, until it is done the feed merges in Pinecone results
+    if fallback:
+        app["index_bootstrap"] = asyncio.create_task(index.bootstrap())
+
+
+@app.on_event("startup")
+async def start_worker(_):
+    # Local runs process the jobs in the web worker instead of `python -m cli.worker`
+    if os.environ.get("JOBS_INPROCESS") == "1":
+        await worker.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_engine(_):
+    await sockets.close()
+    await worker.stop()
+    await memory.close()
+    await upserts.close()
+    await jobs.close()
+    await crawls.close()
+    await responses.close()
+    engine.shutdown()
+
+
 @app.get("/api/assets")
 async def static_dir():
     return await get_assets()
@@ -27,21 +83,102 @@ async def static_dir():
 
 @app.get("/api/chat")
 async def chat(text: str):
-    return await llm.chat_with_memory(
-        text=text, context="You are an MC from Urban Roosters", namespace="hhmc"
-    )
+    response = await chat_reply(text, "hhmc", prompts.render("chat"), scope="hhmc:chat")
+    if not response.cached:  # the cached reply is in memory already
+        await memory.put("hhmc", [response])
+    return response
+
+
+@app.get("/api/responses/cache")
+async def response_cache_stats():
+    """Hit rate of the semantic response cache of `/api/chat` and the battles"""
+    return responses.stats()
+
+
+@app.get("/api/sessions")
+async def session_stats():
+    """Open chat sessions of this worker and the memory held by their recent turns"""
+    return sessions.stats()
+
+
+@app.get("/api/sockets")
+async def socket_stats():
+    """Open chat sockets, messages waiting and in flight, and messages turned away as busy"""
+    return sockets.stats()
 
 
 @app.post("/api/tracks/upsert")
 async def upload_endpoint(request: Request):
-    """Takes an MP3 file, transcodes it to WAV, changes to mono, extracts the FFT and generates an embedding of 1536 dimensions that is upserted to Pinecone for further similarity search, meanwhile save the audio track to the main database, and return the `AudioTrack` object."""
+    """Takes an MP3 file, decodes it to mono PCM, extracts the FFT and generates an embedding of 1536 dimensions that is upserted to Pinecone for further similarity search, meanwhile save the audio track to the main database, and return the `AudioTrack` object."""
     return await audiotrack_handler(request)
 
 
+@app.post("/api/tracks/stream")
+async def stream_upload_endpoint(request: Request):
+    """Same as `/api/tracks/upsert` but streams the upload to S3 and the decoder as it arrives, running the S3, database and embedding stages concurrently."""
+    return await audiotrack_stream_handler(request)
+
+
+@app.post("/api/tracks/bulk")
+async def bulk_upload_endpoint(request: Request):
+    """Ingests many tracks for `user`/`playlist` at once, from uploaded mp3 or zip files or a list of storage keys, streaming back NDJSON progress with one result per track."""
+    return await bulk_ingest_handler(request)
+
+
 @app.get("/api/tracks/feed")
-async def feed_endpoint(url: str):
-    """Returns the 10 KNN for the given track url"""
-    return await audiotrack_feed_handler(url)
+async def feed_endpoint(url: str, request: Request):
+    """Returns the 10 KNN for the given track url, `mode=stft` selects the windowed spectral embedding"""
+    return await audiotrack_feed_handler(url, embedding_mode(request))
+
+
+@app.get("/api/tracks/cache")
+async def cache_stats_endpoint():
+    """Hit and miss counters of the shared embedding cache for this worker"""
+    return await cache.stats()
+
+
+@app.get("/api/http/stats")
+async def http_stats_endpoint():
+    """Connections in use, requests waiting for one and reuse rate of every shared HTTP pool of this worker"""
+    return http.stats()
+
+
+@app.post("/api/jobs")
+async def enqueue_job(request: Request):
+    """Enqueues a background job, the body holds its `kind` (youtube.upsert, tracks.bulk or sitemap.ingest) and `payload`, returns the queued `Job`"""
+    try:
+        data = await request.json()
+    except ValueError as exc:
+        raise HTTPBadRequest(reason="The body is not JSON") from exc
+    if not isinstance(data, dict):
+        raise HTTPBadRequest(reason="The body must be a JSON object")
+    if data.get("kind") not in handlers:
+        raise HTTPBadRequest(reason=f"Unknown job kind {data.get('kind')}")
+    payload = data.get("payload", {})
+    if not isinstance(payload, dict):
+        raise HTTPBadRequest(reason="The payload must be a JSON object")
+    if payload.get("mode", "fft") not in EMBEDDING_VERSIONS:
+        raise HTTPBadRequest(reason=f"Unknown embedding mode {payload['mode']}")
+    job = await jobs.enqueue(data["kind"], payload)
+    return job.dict()
+
+
+@app.get("/api/jobs/{id}")
+async def job_status(id: str):
+    """Status, progress and result of the given job"""
+    job = await jobs.get(id)
+    if job is None:
+        raise HTTPNotFound(reason=f"Job {id} not found")
+    return job.dict()
+
+
+@app.delete("/api/jobs/{id}")
+async def cancel_job(id: str):
+    """Cancels the given job, a queued job never runs and a running one is stopped"""
+    job = await jobs.cancel(id)
+    if job is None:
+        raise HTTPNotFound(reason=f"Job {id} not found")
+    return job.dict()
 
 
 @app.post("/api/auth")
@@ -57,44 +194,156 @@ async def auth_endpoint(request: Request):
     return response.dict()
 
 
-@app.websocket("/api/chat/{ref}")
-async def chat_with_memory(ref: str, category:str, websocket: WebSocketResponse):
-    while True:
-        request = await websocket.receive_str()
-        response = await llm.chat_with_memory(
-            text=request, context=template(request=request,category=category), namespace=ref
+async def chat_with_memory(request: Request):
+    """Chat with the `ref` memory, `stream=true` streams the reply as token frames followed by a done frame"""
+    ref = request.match_info["ref"]
+    category = request.query.get("category", "")
+    stream = request.query.get("stream") in ("1", "true")
+    session = sessions.open(ref)
+
+    async def reply(websocket: WebSocketResponse, text: str):
+        response = await send_reply(
+            websocket,
+            text,
+            ref,
+            prompts.render("battle", request=text, category=category),
+            stream,
+            category=category,
+            session=session,
+        )
+        if not response.cached:
+            await memory.put(ref, [text, response])
+        logger.info(response)
+
+    try:
+        return await sockets.serve(request, reply)
+    finally:
+        sessions.close(session)
+        memory.flush_nowait(ref)
+
+
+async def you_vs_algoritmo(request: Request):
+    """Battle against the algorithm, `stream=true` streams the reply as token frames followed by a done frame"""
+    category = request.match_info["category"]
+    stream = request.query.get("stream") in ("1", "true")
+    session = sessions.open(category)
+
+    async def reply(websocket: WebSocketResponse, text: str):
+        response = await send_reply(
+            websocket,
+            text,
+            category,
+            prompts.render("battle", request=text, category=category),
+            stream,
+            scope=f"hhmc:{category}",
+            category=category,
+            session=session,
+        )
+        if not response.cached:
+            await memory.put(category, [text, response])
+        logger.info(response)
+
+    try:
+        return await sockets.serve(request, reply)
+    finally:
+        sessions.close(session)
+        memory.flush_nowait(category)
+
+
+# Plain routes, the sockets are prepared by the connection manager with its heartbeat
+app.router.add_get("/api/chat/{ref}", chat_with_memory)
+app.router.add_get("/api/hhmc/{category}", you_vs_algoritmo)
+
+
+async def chat_stream(request: Request):
+    """Streams the reply of the `ref` memory to `text` as `token` events and a final `done` event"""
+    ref = request.match_info["ref"]
+    text = required(request, "text")
+    category = request.query.get("category", "")
+    async with sse_response(request) as sse:
+        response = await sse_reply(
+            sse,
+            text,
+            ref,
+            prompts.render("battle", request=text, category=category),
+            category=category,
         )
-        data = await websocket.send_str(response)
-        await llm.ingest(texts=[request, response], namespace=ref)
-        logger.info(data)
-
-@app.websocket("/api/hhmc/{category}")
-async def you_vs_algoritmo(category: str, websocket: WebSocketResponse):
-    while True:
-        request = await websocket.receive_str()
-        response = await llm.chat_with_memory(
-            text=request, context=template(request=request,category=category), namespace=category
+        if not response.cached:
+            await memory.put(ref, [text, response])
+    return sse
+
+
+async def you_vs_algoritmo_stream(request: Request):
+    """Streams the battle reply to `text` as `token` events and a final `done` event"""
+    category = request.match_info["category"]
+    text = required(request, "text")
+    async with sse_response(request) as sse:
+        response = await sse_reply(
+            sse,
+            text,
+            category,
+            prompts.render("battle", request=text, category=category),
+            scope=f"hhmc:{category}",
+            category=category,
         )
-        data = await websocket.send_str(response)
-        await llm.ingest(texts=[request, response], namespace=category)
-        logger.info(data)
+        if not response.cached:
+            await memory.put(category, [text, response])
+    return sse
+
+
+# Plain routes, `app.sse` opens the stream before a missing parameter could be turned away
+app.router.add_get("/api/sse/chat/{ref}", chat_stream)
+app.router.add_get("/api/sse/hhmc/{category}", you_vs_algoritmo_stream)
+
+
+async def sitemap_stream(request: Request):
+    """Crawls the sitemap of `url` into the `namespace` memory, sending an `item` event per page (with its error if it failed) and a final `done` event with the totals"""
+    namespace = request.match_info["namespace"]
+    url = required(request, "url")
+    async with sse_response(request) as sse:
+        async for result in sitemap_pipeline(url, namespace):
+            event = "done" if result["status"] == "done" else "item"
+            await sse.send(json.dumps(result, cls=JSONEncoder), event=event)
+    return sse
+
+
+app.router.add_get("/api/sse/sitemap/{namespace}", sitemap_stream)
 
 
 @app.get("/api/youtube/{id}")
-async def youtube_search(id: str):
+async def youtube_search(id: str, request: Request):
+    """Returns the details of the related videos, fetched concurrently, and upserts the short ones in the background. With `stream=true` the details are streamed as NDJSON as they arrive."""
     responses = await yt.search(id=id)
-    items = []
-    for response in responses:
-        item = await yt.details(response)
+    if request.query.get("stream") not in ("1", "true"):
+        items = [item async for item in yt.details_many(responses)]
+        yt.schedule_upserts(items, source=id)
+        return items
+    response = StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    semaphore = asyncio.Semaphore(2)
+    async for item in yt.details_many(responses):
         logger.info(item)
-        items.append(item)
-        if item.duration > 300:
-            continue
-        await yt.upsert(response)
-    return items
+        yt.schedule_upserts([item], semaphore, source=id)
+        await response.write(item.json().encode() + b"\n")
+    await response.write_eof()
+    return response
+
+
+@app.get("/api/youtube/{id}/status")
+async def youtube_status(id: str):
+    """Background upsert status (queued, running, done, ingested, skipped or error) of the related videos scheduled by the last searches of the given video"""
+    if id not in yt.scheduled:
+        raise HTTPNotFound(reason="No upserts were scheduled for this video")
+    return {video: yt.status.get(video, "unknown") for video in yt.scheduled[id]}
+
 
 app.router.add_static("/static", "static",show_index=True)
 
+if isinstance(storage, LocalStorage):
+    # what LocalStorage.url points to, S3 serves its own objects
+    os.makedirs(storage.root, exist_ok=True)
+    app.router.add_static("/storage", storage.root)
+
 
 
 cors = aiohttp_cors.setup(app)
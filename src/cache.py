@@ -0,0 +1,454 @@
+import fcntl
+import hashlib
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from aiofauna.helpers import ThreadPoolExecutor, asyncify
+from cheapcone import Vector
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # the in-memory response cache works without it
+    aioredis = None
+
+from .utils import EMBEDDING_DIM, EmbeddingMode, embedding_version
+
+Cached = Tuple[Vector, float]
+
+
+class EmbeddingCache(object):
+    """
+    Content addressed embedding store shared by every gunicorn worker in the container.
+    Vectors live in a memory mapped float32 matrix, an SQLite index maps keys (content
+    hashes, track urls, video ids) to rows and evicts the least recently used row when full.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    def __init__(self, path: str, capacity: int = 8192, dim: int = EMBEDDING_DIM):
+        self.path = path
+        self.capacity = capacity
+        self.dim = dim
+        self.hits = 0
+        self.misses = 0
+        self._matrix: Optional[np.memmap] = None
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def matrix(self) -> np.memmap:
+        if self._matrix is None:
+            os.makedirs(self.path, exist_ok=True)
+            filename = os.path.join(self.path, "vectors.f32")
+            size = self.capacity * self.dim * 4
+            with open(filename, "ab") as f:
+                if f.tell() < size:
+                    f.truncate(size)
+            self._matrix = np.memmap(
+                filename, dtype=np.float32, mode="r+", shape=(self.capacity, self.dim)
+            )
+        return self._matrix
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(self.path, exist_ok=True)
+            self._db = sqlite3.connect(
+                os.path.join(self.path, "index.db"),
+                isolation_level=None,
+                check_same_thread=False,
+                timeout=30,
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS slots (slot INTEGER PRIMARY KEY, duration REAL, used REAL)"
+            )
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS keys (key TEXT PRIMARY KEY, slot INTEGER)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS keys_slot ON keys (slot)")
+        return self._db
+
+    @contextmanager
+    def _lock(self, operation: int):
+        """flock on the index so a row is never read while another worker rewrites it"""
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, "index.lock"), "a") as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def digest_key(
+        hexdigest: str, mode: EmbeddingMode = "fft", decoder: Optional[str] = None
+    ) -> str:
+        """`decoder` names a decoding other than pydub at the native rate, its PCM and so its vector differ"""
+        version = embedding_version(mode)
+        if decoder is not None:
+            version = f"{version}+{decoder}"
+        return f"{version}:sha256:{hexdigest}"
+
+    @classmethod
+    def content_key(cls, binary_audio: bytes, mode: EmbeddingMode = "fft") -> str:
+        return cls.digest_key(hashlib.sha256(binary_audio).hexdigest(), mode)
+
+    @staticmethod
+    def alias_key(name: str, mode: EmbeddingMode = "fft") -> str:
+        return f"{embedding_version(mode)}:{name}"
+
+    @asyncify
+    def get(self, *keys: str) -> Optional[Cached]:
+        """Returns the cached vector and duration for the first of `keys` that is present"""
+        with self._lock(fcntl.LOCK_SH):
+            for key in keys:
+                row = self.db.execute(
+                    "SELECT slots.slot, slots.duration FROM keys JOIN slots USING (slot) WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None:
+                    break
+            else:
+                self.misses += 1
+                return None
+            slot, duration = row
+            vector = self.matrix[slot].tolist()
+            self.db.execute(
+                "UPDATE slots SET used = ? WHERE slot = ?", (time.time(), slot)
+            )
+        self.hits += 1
+        return vector, duration
+
+    @asyncify
+    def put(self, keys: List[str], vector: Vector, duration: float = 0):
+        """
+        Stores the vector under every given key. A row one of the keys already points to is
+        overwritten (concurrent misses of the same content, url aliases), otherwise a row no
+        key points to anymore is reused, then a new one, then the least recently used one.
+        """
+        with self._lock(fcntl.LOCK_EX):
+            db = self.db
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                marks = ", ".join("?" * len(keys))
+                existing = db.execute(
+                    f"SELECT slot FROM keys WHERE key IN ({marks}) ORDER BY slot", keys
+                ).fetchone()
+                orphan = db.execute(
+                    """SELECT slot FROM slots WHERE NOT EXISTS
+                       (SELECT 1 FROM keys WHERE keys.slot = slots.slot) LIMIT 1"""
+                ).fetchone()
+                (count,) = db.execute("SELECT COUNT(*) FROM slots").fetchone()
+                if existing is not None:
+                    (slot,) = existing
+                elif orphan is not None:
+                    (slot,) = orphan
+                elif count < self.capacity:
+                    slot = count
+                else:
+                    (slot,) = db.execute(
+                        "SELECT slot FROM slots ORDER BY used LIMIT 1"
+                    ).fetchone()
+                    db.execute("DELETE FROM keys WHERE slot = ?", (slot,))
+                self.matrix[slot] = np.asarray(vector, dtype=np.float32)
+                self.matrix.flush()
+                db.execute(
+                    "INSERT OR REPLACE INTO slots VALUES (?, ?, ?)",
+                    (slot, duration, time.time()),
+                )
+                db.executemany(
+                    "INSERT OR REPLACE INTO keys VALUES (?, ?)",
+                    [(key, slot) for key in keys],
+                )
+                db.execute("COMMIT")
+            except Exception:
+                db.execute("ROLLBACK")
+                raise
+
+    async def fetch(
+        self, keys: List[str], embed: Callable[[], Awaitable[Cached]]
+    ) -> Cached:
+        """Returns the first cached hit among `keys`, otherwise embeds and stores under all of them"""
+        cached = await self.get(*keys)
+        if cached is not None:
+            return cached
+        vector, duration = await embed()
+        await self.put(keys, vector, duration)
+        return vector, duration
+
+    @asyncify
+    def stats(self):
+        """Counters of this worker, the size is that of the cache every worker shares"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": self.db.execute("SELECT COUNT(DISTINCT slot) FROM keys").fetchone()[0],
+            "capacity": self.capacity,
+        }
+
+
+class IngestedVideos(object):
+    """
+    Persistent record of the videos already upserted to `audio_tracks` and the embedding
+    version they were computed with, so a video is only downloaded and embedded again
+    when that version changes
+    """
+
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False, timeout=30
+            )
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS videos (id TEXT PRIMARY KEY, version TEXT, ts REAL)"
+            )
+        return self._db
+
+    @asyncify
+    def seen(self, id: str, version: str) -> bool:
+        row = self.db.execute("SELECT version FROM videos WHERE id = ?", (id,)).fetchone()
+        return row is not None and row[0] == version
+
+    @asyncify
+    def mark(self, id: str, version: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO videos VALUES (?, ?, ?)", (id, version, time.time())
+        )
+
+
+def unit(vector: Vector) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(array)
+    return array / norm if norm else array
+
+
+class ResponseCache(ABC):
+    """
+    Semantic cache of LLM replies: a prompt is answered from the cache when a prompt of
+    the same `scope` (namespace and category) with a cosine similarity of at least
+    `threshold` was answered less than `ttl` seconds ago. Holds at most `size` replies,
+    evicting the least recently used one.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, size: int = 1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+
+    def _best(
+        self, vector: Vector, entries: List[Tuple[str, np.ndarray]]
+    ) -> Optional[Tuple[str, float]]:
+        if not entries:
+            return None
+        scores = np.stack([entry for _, entry in entries]) @ unit(vector)
+        best = int(np.argmax(scores))
+        return entries[best][0], float(scores[best])
+
+    def _count(self, hit: bool):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    @abstractmethod
+    async def get(self, scope: str, vector: Vector) -> Optional[str]:
+        """Returns the cached reply to the most similar prompt of the scope, if close enough"""
+
+    @abstractmethod
+    async def put(self, scope: str, vector: Vector, response: str):
+        ...
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "threshold": self.threshold,
+            "ttl": self.ttl,
+            "capacity": self.size,
+        }
+
+
+class MemoryResponseCache(ResponseCache):
+    """Per worker response cache"""
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, size: int = 1000):
+        super().__init__(threshold, ttl, size)
+        self.entries: "OrderedDict[str, Tuple[str, np.ndarray, str, float]]" = OrderedDict()
+        self.scopes: Dict[str, Dict[str, np.ndarray]] = {}
+
+    def _remove(self, id: str):
+        scope, *_ = self.entries.pop(id)
+        del self.scopes[scope][id]
+        if not self.scopes[scope]:
+            del self.scopes[scope]
+
+    async def get(self, scope: str, vector: Vector) -> Optional[str]:
+        now = time.time()
+        for id in [id for id in self.scopes.get(scope, {}) if self.entries[id][3] < now]:
+            self._remove(id)
+        best = self._best(vector, list(self.scopes.get(scope, {}).items()))
+        hit = best is not None and best[1] >= self.threshold
+        self._count(hit)
+        if not hit:
+            return None
+        self.entries.move_to_end(best[0])  # type: ignore
+        return self.entries[best[0]][2]  # type: ignore
+
+    async def put(self, scope: str, vector: Vector, response: str):
+        id = hashlib.sha256(unit(vector).tobytes()).hexdigest()
+        if id in self.entries:
+            self._remove(id)
+        self.entries[id] = (scope, unit(vector), response, time.time() + self.ttl)
+        self.scopes.setdefault(scope, {})[id] = self.entries[id][1]
+        while len(self.entries) > self.size:
+            self._remove(next(iter(self.entries)))
+
+    def stats(self):
+        return {**super().stats(), "size": len(self.entries)}
+
+
+class RedisResponseCache(ResponseCache):
+    """
+    Response cache shared by every worker: each scope is a Redis hash of replies, a hash of
+    their prompt vectors as raw float32 and sorted sets of last uses and expiry times,
+    `size` is enforced per scope. A lookup compares the prompt against the vectors of the
+    `sample` most recently used replies and only then fetches the matched reply.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        threshold: float = 0.95,
+        ttl: float = 3600,
+        size: int = 1000,
+        sample: int = 256,
+        prefix: str = "hhmc:responses",
+    ):
+        if aioredis is None:
+            raise RuntimeError("The redis package is required for the Redis response cache")
+        super().__init__(threshold, ttl, size)
+        self.url = url
+        self.sample = sample
+        self.prefix = prefix
+        self._redis: Optional["aioredis.Redis"] = None
+        self._vectors: Optional["aioredis.Redis"] = None
+
+    @property
+    def redis(self) -> "aioredis.Redis":
+        if self._redis is None:
+            self._redis = aioredis.from_url(self.url, decode_responses=True)
+        return self._redis
+
+    @property
+    def vectors(self) -> "aioredis.Redis":
+        """Client for the vector hashes, their values are bytes and must not be decoded"""
+        if self._vectors is None:
+            self._vectors = aioredis.from_url(self.url)
+        return self._vectors
+
+    async def _remove(self, key: str, ids: List[str]):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(key, *ids)
+            pipe.hdel(f"{key}:vectors", *ids)
+            pipe.zrem(f"{key}:used", *ids)
+            pipe.zrem(f"{key}:expires", *ids)
+            await pipe.execute()
+
+    async def get(self, scope: str, vector: Vector) -> Optional[str]:
+        key = f"{self.prefix}:{scope}"
+        now = time.time()
+        expired = await self.redis.zrangebyscore(f"{key}:expires", "-inf", now)
+        if expired:
+            await self._remove(key, expired)
+        ids = await self.redis.zrevrange(f"{key}:used", 0, self.sample - 1)
+        values = await self.vectors.hmget(f"{key}:vectors", ids) if ids else []
+        best = self._best(
+            vector,
+            [
+                (id, np.frombuffer(value, dtype=np.float32))
+                for id, value in zip(ids, values)
+                if value is not None
+            ],
+        )
+        response = None
+        if best is not None and best[1] >= self.threshold:
+            # evicted by another worker since the vectors were read, counts as a miss
+            response = await self.redis.hget(key, best[0])
+        self._count(response is not None)
+        if response is None:
+            return None
+        await self.redis.zadd(f"{key}:used", {best[0]: now})  # type: ignore
+        return response
+
+    async def put(self, scope: str, vector: Vector, response: str):
+        key = f"{self.prefix}:{scope}"
+        array = unit(vector)
+        id = hashlib.sha256(array.tobytes()).hexdigest()
+        now = time.time()
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(key, id, response)
+            pipe.hset(f"{key}:vectors", id, array.tobytes())
+            pipe.zadd(f"{key}:used", {id: now})
+            pipe.zadd(f"{key}:expires", {id: now + self.ttl})
+            for suffix in ("", ":vectors", ":used", ":expires"):
+                pipe.expire(f"{key}{suffix}", int(self.ttl))
+            await pipe.execute()
+        excess = await self.redis.zcard(f"{key}:used") - self.size
+        if excess > 0:
+            evicted = [id for id, _ in await self.redis.zpopmin(f"{key}:used", excess)]
+            await self._remove(key, evicted)
+
+    async def close(self):
+        for client in (self._redis, self._vectors):
+            if client is not None:
+                await client.close()
+
+
+def get_response_cache() -> ResponseCache:
+    config = dict(
+        threshold=float(os.environ.get("RESPONSE_CACHE_THRESHOLD", 0.95)),
+        ttl=float(os.environ.get("RESPONSE_CACHE_TTL", 3600)),
+        size=int(os.environ.get("RESPONSE_CACHE_SIZE", 1000)),
+    )
+    default = "redis" if "REDIS_URL" in os.environ else "memory"
+    if os.environ.get("RESPONSE_CACHE_BACKEND", default) == "redis":
+        return RedisResponseCache(
+            os.environ["REDIS_URL"],
+            sample=int(os.environ.get("RESPONSE_CACHE_SAMPLE", 256)),
+            **config,  # type: ignore
+        )
+    return MemoryResponseCache(**config)  # type: ignore
+
+
+cache = EmbeddingCache(
+    path=os.environ.get("EMBEDDING_CACHE_DIR", "/tmp/hhmc-embeddings"),
+    capacity=int(os.environ.get("EMBEDDING_CACHE_SIZE", 8192)),
+)
+ingested = IngestedVideos(
+    path=os.environ.get("INGESTED_VIDEOS_PATH", "/tmp/hhmc-embeddings/videos.db")
+)
+responses = get_response_cache()
@@ -0,0 +1,170 @@
+import time
+from typing import AsyncIterator, List, Optional
+
+import openai
+from aiofauna import EventSourceResponse, WebSocketResponse, setup_logging
+from aiofauna.llm import LLMStack
+from cheapcone import QueryBuilder, Vector
+
+from .cache import responses
+from .clients import pinecone, use_openai_pool
+from .prompts import prompts
+from .sessions import Session, sessions
+
+logger = setup_logging(__name__)
+llm = LLMStack()
+
+
+class Reply(str):
+    """A reply, `cached` when the response cache answered it and memory already holds it"""
+
+    cached = False
+
+
+def join(tokens: List[str]) -> Reply:
+    reply = Reply("".join(tokens))
+    reply.cached = any(getattr(token, "cached", False) for token in tokens)
+    return reply
+
+
+async def retrieve(
+    text: str, namespace: str, vector: Vector, category: Optional[str] = None
+) -> str:
+    """Returns the texts of the namespace memory most similar to `text`, within the token budget of the category"""
+    query = (QueryBuilder()("namespace") == namespace).query
+    response = await pinecone.query(expr=query, vector=vector)
+    matches = sorted(response.matches, key=lambda match: match.score, reverse=True)
+    return prompts.memories(
+        text, [match.metadata["text"] for match in matches], category  # type: ignore
+    )
+
+
+async def stream_chat_with_memory(
+    text: str,
+    namespace: str,
+    context: str,
+    scope: Optional[str] = None,
+    category: Optional[str] = None,
+    session: Optional[Session] = None,
+) -> AsyncIterator[str]:
+    """
+    Same retrieval and completion as `LLMStack.chat_with_memory`, but yields the reply
+    token by token as OpenAI generates it and keeps the given `context` next to the
+    retrieved memories, trimmed to the token budget of the `category`. With a `scope` a
+    similar enough prompt of that scope is answered from the response cache in a single
+    `Reply` chunk flagged as `cached`. The recent turns of a `session` are sent as they are, and while they cover the
+    whole conversation the memories retrieved for its first message are reused instead of
+    searching the vector store again. Time to first token and total time are logged per
+    message.
+    """
+    use_openai_pool()
+    start = time.perf_counter()
+    first: Optional[float] = None
+    search = session is None or session.needs_retrieval()
+    vector: Optional[Vector] = None
+    if search or scope is not None:
+        vector = await llm.create_embedding(text)
+    if scope is not None:
+        cached = await responses.get(scope, vector)  # type: ignore
+        if cached is not None:
+            logger.info("Cached reply for %s in %.3fs", scope, time.perf_counter() - start)
+            if session is not None:
+                sessions.record(session, text, cached)
+            reply = Reply(cached)
+            reply.cached = True
+            yield reply
+            return
+    background: Optional[str] = None
+    if search:
+        memories = background = await retrieve(text, namespace, vector, category)  # type: ignore
+    else:
+        memories = session.background  # type: ignore
+    messages = [
+        *(session.messages() if session is not None else []),
+        {"role": "user", "content": text},
+        {"role": "system", "content": f"{context}\n{memories}"},
+    ]
+    response = await openai.ChatCompletion.acreate(
+        model=llm.model, messages=messages, stream=True
+    )
+    tokens = []
+    async for chunk in response:  # type: ignore
+        token = chunk["choices"][0]["delta"].get("content")
+        if not token:
+            continue
+        if first is None:
+            first = time.perf_counter() - start
+            logger.info("Time to first token for %s: %.3fs", namespace, first)
+        tokens.append(token)
+        yield token
+    logger.info(
+        "Streamed reply for %s in %.3fs (first token %.3fs)",
+        namespace,
+        time.perf_counter() - start,
+        first or 0,
+    )
+    if session is not None:
+        sessions.record(session, text, "".join(tokens), background)
+    if scope is not None and tokens:
+        await responses.put(scope, vector, "".join(tokens))  # type: ignore
+
+
+async def chat_with_memory(
+    text: str,
+    namespace: str,
+    context: str,
+    scope: Optional[str] = None,
+    category: Optional[str] = None,
+    session: Optional[Session] = None,
+) -> Reply:
+    """Returns the whole reply of `stream_chat_with_memory`"""
+    tokens = stream_chat_with_memory(text, namespace, context, scope, category, session)
+    return join([token async for token in tokens])
+
+
+async def send_reply(
+    websocket: WebSocketResponse,
+    text: str,
+    namespace: str,
+    context: str,
+    stream: bool,
+    scope: Optional[str] = None,
+    category: Optional[str] = None,
+    session: Optional[Session] = None,
+) -> Reply:
+    """
+    Answers a websocket message and returns the full reply. The plain mode sends the reply
+    as a single text frame, the streaming mode sends `{"type": "token", "data": ...}`
+    frames as they arrive and a final `{"type": "done", "data": <full reply>}` frame.
+    """
+    if not stream:
+        response = await chat_with_memory(text, namespace, context, scope, category, session)
+        await websocket.send_str(response)
+        return response
+    tokens = []
+    async for token in stream_chat_with_memory(
+        text, namespace, context, scope, category, session
+    ):
+        tokens.append(token)
+        await websocket.send_json({"type": "token", "data": token})
+    response = join(tokens)
+    await websocket.send_json({"type": "done", "data": response})
+    return response
+
+
+async def sse_reply(
+    sse: EventSourceResponse,
+    text: str,
+    namespace: str,
+    context: str,
+    scope: Optional[str] = None,
+    category: Optional[str] = None,
+) -> Reply:
+    """Streams the reply as `token` events followed by a `done` event with the full reply"""
+    tokens = []
+    async for token in stream_chat_with_memory(text, namespace, context, scope, category):
+        tokens.append(token)
+        await sse.send(token, event="token")
+    response = join(tokens)
+    await sse.send(response, event="done")
+    return response
@@ -0,0 +1,209 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Optional
+
+import openai
+from aiofauna import setup_logging
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, TraceConfig
+from cheapcone import (Embedding, Query, QueryRequest, QueryResponse,
+                       UpsertRequest, UpsertResponse, Vector)
+
+logger = setup_logging(__name__)
+
+
+class HTTPPool(object):
+    """
+    A long-lived `ClientSession` with its own connector, so connections, keep-alive and
+    the DNS cache are reused across requests. Connection events are traced to report how
+    many connections are in use, how many requests wait for one and how often one is reused.
+    Pools for long transfers set no `timeout` in total but still bound connecting and every
+    read with `connect_timeout` and `read_timeout`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int = 100,
+        limit_per_host: int = 20,
+        ttl_dns_cache: int = 300,
+        keepalive_timeout: float = 60,
+        timeout: Optional[float] = 60,
+        connect_timeout: Optional[float] = None,
+        read_timeout: Optional[float] = None,
+        **kwargs: Any,
+    ):
+        self.name = name
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.kwargs = kwargs
+        self.created = 0
+        self.reused = 0
+        self.waiting = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+        self._session: Optional[ClientSession] = None
+
+    def _trace(self) -> TraceConfig:
+        trace = TraceConfig()
+
+        async def on_create(*_):
+            self.created += 1
+
+        async def on_reuse(*_):
+            self.reused += 1
+
+        async def on_queued(*_):
+            self.waiting += 1
+
+        async def on_dequeued(*_):
+            self.waiting -= 1
+
+        async def on_dns_hit(*_):
+            self.dns_hits += 1
+
+        async def on_dns_miss(*_):
+            self.dns_misses += 1
+
+        trace.on_connection_create_end.append(on_create)
+        trace.on_connection_reuseconn.append(on_reuse)
+        trace.on_connection_queued_start.append(on_queued)
+        trace.on_connection_queued_end.append(on_dequeued)
+        trace.on_dns_cache_hit.append(on_dns_hit)
+        trace.on_dns_cache_miss.append(on_dns_miss)
+        return trace
+
+    @property
+    def session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                connector=TCPConnector(
+                    limit=self.limit,
+                    limit_per_host=self.limit_per_host,
+                    use_dns_cache=True,
+                    ttl_dns_cache=self.ttl_dns_cache,
+                    keepalive_timeout=self.keepalive_timeout,
+                ),
+                timeout=ClientTimeout(
+                    total=self.timeout,
+                    connect=self.connect_timeout,
+                    sock_read=self.read_timeout,
+                ),
+                trace_configs=[self._trace()],
+                **self.kwargs,
+            )
+        return self._session
+
+    def stats(self) -> Dict[str, Any]:
+        connector = self._session.connector if self._session is not None else None
+        connections = self.created + self.reused
+        return {
+            "limit": self.limit,
+            "limit_per_host": self.limit_per_host,
+            "in_use": len(getattr(connector, "_acquired", ())),
+            "waiting": self.waiting,
+            "created": self.created,
+            "reused": self.reused,
+            "reuse_rate": self.reused / connections if connections else 0.0,
+            "dns_hits": self.dns_hits,
+            "dns_misses": self.dns_misses,
+        }
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+
+class HTTPRegistry(object):
+    """
+    Named HTTP pools shared by every outbound call of the worker, opened when the app
+    starts and closed on cleanup
+    """
+
+    def __init__(self):
+        self.pools: Dict[str, HTTPPool] = {}
+
+    def register(self, name: str, **config: Any) -> HTTPPool:
+        self.pools[name] = HTTPPool(name, **config)
+        return self.pools[name]
+
+    def session(self, name: str = "default") -> ClientSession:
+        if name not in self.pools:
+            self.register(name)
+        return self.pools[name].session
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        return {name: pool.stats() for name, pool in self.pools.items()}
+
+    async def startup(self, _=None):
+        for pool in self.pools.values():
+            pool.session  # pylint: disable=pointless-statement
+
+    async def cleanup(self, _=None):
+        await asyncio.gather(*[pool.close() for pool in self.pools.values()])
+
+
+http = HTTPRegistry()
+http.register("default", limit=100, limit_per_host=10)
+http.register(
+    "media", limit=32, limit_per_host=8, timeout=None, connect_timeout=10, read_timeout=60
+)
+http.register(
+    "storage", limit=64, limit_per_host=64, timeout=None, connect_timeout=10, read_timeout=60
+)
+http.register("crawler", limit=200, limit_per_host=8, timeout=30)
+http.register(
+    "openai", limit=100, limit_per_host=50, timeout=None, connect_timeout=10, read_timeout=60
+)
+
+
+def use_openai_pool():
+    """
+    Sends the openai calls of the current task through the shared `openai` pool, the
+    package otherwise opens and closes a session for every call
+    """
+    openai.aiosession.set(http.session("openai"))
+
+
+class PineconeAPI(object):
+    """
+    The Pinecone REST calls, sent over the shared `default` pool instead of the session per
+    call cheapcone's client opens, with the schemas of cheapcone
+    """
+
+    def __init__(self, url: str, api_key: str, pool: str = "default"):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.pool = pool
+
+    async def post(self, path: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        async with http.session(self.pool).post(
+            f"{self.url}{path}", json=payload, headers={"Api-Key": self.api_key}
+        ) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def upsert(self, embeddings: List[Embedding]) -> UpsertResponse:
+        vectors = [
+            UpsertRequest(values=embedding.values, metadata=embedding.metadata).dict()
+            for embedding in embeddings
+        ]
+        return UpsertResponse(**await self.post("/vectors/upsert", {"vectors": vectors}))
+
+    async def query(
+        self, expr: Query, vector: Vector, includeMetadata: bool = True, topK: int = 10
+    ) -> QueryResponse:
+        payload = QueryRequest(
+            topK=topK, filter=expr, vector=vector, includeMetadata=includeMetadata
+        ).dict()
+        return QueryResponse(**await self.post("/query", payload))
+
+
+pinecone = PineconeAPI(
+    os.environ.get("PINECONE_API_URL", ""), os.environ.get("PINECONE_API_KEY", "")
+)
@@ -0,0 +1,159 @@
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+from aiofauna import setup_logging
+from aiofauna.helpers import ThreadPoolExecutor, asyncify
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # the SQLite store is enough for local runs
+    aioredis = None
+
+logger = setup_logging(__name__)
+
+
+@dataclass
+class PageState:
+    """What the last crawl of a page saw: its validators, sitemap `<lastmod>` and text hash"""
+
+    url: str
+    etag: Optional[str] = None
+    modified: Optional[str] = None
+    lastmod: Optional[str] = None
+    digest: Optional[str] = None
+    crawled: float = field(default_factory=time.time)
+
+    def dict(self) -> Dict[str, Optional[str]]:
+        return asdict(self)
+
+
+class CrawlStore(ABC):
+    """Crawl state of every page ingested into a namespace, kept across crawls"""
+
+    @abstractmethod
+    async def get(self, namespace: str, url: str) -> Optional[PageState]:
+        ...
+
+    @abstractmethod
+    async def put(self, namespace: str, states: List[PageState]):
+        ...
+
+    async def close(self):
+        pass
+
+
+class SQLiteCrawlStore(CrawlStore):
+    """Single file crawl store for local runs, shared by every process on the host"""
+
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False, timeout=30
+            )
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS pages (
+                    namespace TEXT, url TEXT, etag TEXT, modified TEXT, lastmod TEXT,
+                    digest TEXT, crawled REAL, PRIMARY KEY (namespace, url)
+                )"""
+            )
+        return self._db
+
+    @asyncify
+    def get(self, namespace: str, url: str) -> Optional[PageState]:
+        row = self.db.execute(
+            "SELECT * FROM pages WHERE namespace = ? AND url = ?", (namespace, url)
+        ).fetchone()
+        if row is None:
+            return None
+        return PageState(
+            url=row["url"],
+            etag=row["etag"],
+            modified=row["modified"],
+            lastmod=row["lastmod"],
+            digest=row["digest"],
+            crawled=row["crawled"],
+        )
+
+    @asyncify
+    def put(self, namespace: str, states: List[PageState]):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    namespace,
+                    state.url,
+                    state.etag,
+                    state.modified,
+                    state.lastmod,
+                    state.digest,
+                    state.crawled,
+                )
+                for state in states
+            ],
+        )
+
+    async def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+class RedisCrawlStore(CrawlStore):
+    """Redis crawl store, a hash per namespace holding the state of each url as JSON"""
+
+    def __init__(self, url: str, prefix: str = "hhmc:crawls"):
+        if aioredis is None:
+            raise RuntimeError("The redis package is required for the Redis crawl store")
+        self.url = url
+        self.prefix = prefix
+        self._redis: Optional["aioredis.Redis"] = None
+
+    @property
+    def redis(self) -> "aioredis.Redis":
+        if self._redis is None:
+            self._redis = aioredis.from_url(self.url, decode_responses=True)
+        return self._redis
+
+    def _key(self, namespace: str) -> str:
+        return f"{self.prefix}:{namespace}"
+
+    async def get(self, namespace: str, url: str) -> Optional[PageState]:
+        data = await self.redis.hget(self._key(namespace), url)
+        return PageState(**json.loads(data)) if data is not None else None
+
+    async def put(self, namespace: str, states: List[PageState]):
+        if states:
+            await self.redis.hset(
+                self._key(namespace),
+                mapping={state.url: json.dumps(state.dict()) for state in states},
+            )
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+
+def get_crawl_store() -> CrawlStore:
+    default = "redis" if "REDIS_URL" in os.environ else "sqlite"
+    if os.environ.get("CRAWLS_BACKEND", default) == "redis":
+        return RedisCrawlStore(os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+    return SQLiteCrawlStore(os.environ.get("CRAWLS_PATH", "/tmp/hhmc-crawls/crawls.db"))
+
+
+crawls = get_crawl_store()
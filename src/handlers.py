@@ -1,75 +1,187 @@
 import asyncio
+import hashlib
+import json
+import os
 import re
 
-from aiofauna import FileField, Request
+from aiofauna import FileField, JSONEncoder, Request
 from aiofauna.llm import LLMStack
-from aiohttp import ClientSession
-from boto3 import Session
+from aiohttp import BodyPartReader
+from aiohttp.web import StreamResponse
+from aiohttp.web_exceptions import HTTPBadRequest
 from cheapcone import Embedding, List, QueryBuilder
 
+from .cache import cache
+from .clients import http
+from .index import audio_knn, index
+from .ingest import BulkIngestion, request_items
+from .queues import upserts
 from .schemas import AudioTrack
-from .utils import list_assets, mp3_to_vect
+from .storage import storage
+from .utils import (EMBEDDING_VERSIONS, EmbeddingMode, StreamDecoder, engine,
+                    list_assets)
 
 Vector = List[float]
 
 llm = LLMStack()
-aws = Session()
-s3 = aws.client("s3")
 q = QueryBuilder()
 
+CHUNK_SIZE = 2**16
+FEED_MAX_SIZE = int(os.environ.get("FEED_MAX_SIZE", 50 * 2**20))
+
+
+def embedding_mode(request: Request) -> EmbeddingMode:
+    """The `mode` query parameter, rejected with a 400 before any work starts unless it is a known mode"""
+    mode = request.query.get("mode", "fft")
+    if mode not in EMBEDDING_VERSIONS:
+        raise HTTPBadRequest(reason=f"Unknown embedding mode {mode}, use fft or stft")
+    return mode  # type: ignore
+
+
+def required(request: Request, name: str) -> str:
+    """A query parameter the route cannot do without, checked before any response is sent"""
+    value = request.query.get(name)
+    if not value:
+        raise HTTPBadRequest(reason=f"Missing query parameter {name}")
+    return value
+
 
 async def audiotrack_handler(request: Request):
-    """Takes an MP3 file, transcodes it to WAV, changes to mono, extracts the FFT and generates an embedding of 1536 dimensions that is upserted to Pinecone for further similarity search, meanwhile save the audio track to the main database, and return the `AudioTrack` object."""
+    """Takes an MP3 file, decodes it to mono PCM, extracts the FFT and generates an embedding of 1536 dimensions that is upserted to Pinecone for further similarity search, meanwhile save the audio track to the main database, and return the `AudioTrack` object."""
     user = request.query.get("user")
     playlist = request.query.get("playlist")
+    mode = embedding_mode(request)
     audio_mp3 = (await request.post())["file"]
     assert isinstance(audio_mp3, FileField)
     binary_mp3 = audio_mp3.file.read()
-    s3.put_object(Bucket="audio-aiofauna", Key=f"{user}/{playlist}/{audio_mp3.filename}", Body=binary_mp3)  # type: ignore
-    normalized_embedding, duration = mp3_to_vect(binary_mp3)
+    url = await storage.put(f"{user}/{playlist}/{audio_mp3.filename}", binary_mp3)
+    normalized_embedding, duration = await cache.fetch(
+        [cache.content_key(binary_mp3, mode)],
+        lambda: engine.mp3_to_vect(binary_mp3, mode),  # type: ignore
+    )
     audio_track = await AudioTrack(
         playlist=playlist,  # type: ignore
-        url=f"https://audio-aiofauna.s3.amazonaws.com/{user}/{playlist}/  {audio_mp3.filename}",  # type: ignore
+        url=url,  # type: ignore
         user=user,  # type: ignore
         duration=duration,  # type: ignore
         title=audio_mp3.filename,  # type: ignore
     ).save()
     assert isinstance(audio_track, AudioTrack)
     metadata = audio_track.dict()
-    await llm.pinecone.upsert(
-        [Embedding(values=normalized_embedding, metadata=metadata)]  # type: ignore
-    )
+    embeddings = [Embedding(values=normalized_embedding, metadata=metadata)]  # type: ignore
+    await upserts.put(embeddings)
+    await index.upsert(embeddings)
+    return audio_track
+
+
+async def audiotrack_stream_handler(request: Request):
+    """Streaming variant of `audiotrack_handler`: the multipart body is read chunk by chunk and every chunk goes both to an S3 multipart upload and to the decoder as it arrives. Once the body ends the S3 upload, the embedding and the database save run concurrently, so the latency is that of the slowest stage."""
+    user = request.query.get("user")
+    playlist = request.query.get("playlist")
+    mode = embedding_mode(request)
+    reader = await request.multipart()
+    async for part in reader:
+        if isinstance(part, BodyPartReader) and part.name == "file":
+            break
+    else:
+        raise HTTPBadRequest(reason="Missing `file` field")
+    key = f"{user}/{playlist}/{part.filename}"
+    upload = storage.writer(key)
+    decoder = await StreamDecoder().start()
+    digest = hashlib.sha256()
+    try:
+        while chunk := await part.read_chunk(CHUNK_SIZE):
+            digest.update(chunk)
+            await upload.write(chunk)
+            await decoder.feed(chunk)
+        pcm = await decoder.finish()
+    except BaseException:
+        decoder.kill()
+        await upload.abort()
+        raise
+
+    async def embed():
+        return await engine.pcm_to_vect(pcm, mode), decoder.duration  # type: ignore
+
+    try:
+        _, (normalized_embedding, _), audio_track = await asyncio.gather(
+            upload.complete(),
+            cache.fetch([cache.digest_key(digest.hexdigest(), mode, decoder.name)], embed),
+            AudioTrack(
+                playlist=playlist,  # type: ignore
+                url=storage.url(key),  # type: ignore
+                user=user,  # type: ignore
+                duration=decoder.duration,  # type: ignore
+                title=part.filename,  # type: ignore
+            ).save(),
+        )
+    except BaseException:
+        await upload.abort()
+        raise
+    assert isinstance(audio_track, AudioTrack)
+    embeddings = [Embedding(values=normalized_embedding, metadata=audio_track.dict())]  # type: ignore
+    await asyncio.gather(upserts.put(embeddings), index.upsert(embeddings))
     return audio_track
 
 
-async def audiotrack_feed_handler(url: str):
+async def bulk_ingest_handler(request: Request):
+    """Ingests many tracks for a user/playlist in one request through the staged `BulkIngestion` pipeline, streaming back one NDJSON line per track as it completes and a final summary."""
+    ingestion = BulkIngestion(
+        user=required(request, "user"),
+        playlist=required(request, "playlist"),
+        mode=embedding_mode(request),
+    )
+    response = StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    async for result in ingestion.run(request_items(ingestion, request)):
+        await response.write(json.dumps(result, cls=JSONEncoder).encode() + b"\n")
+    await response.write_eof()
+    return response
+
+
+async def download(url: str, max_size: int = FEED_MAX_SIZE) -> bytes:
+    """Reads the audio at a caller supplied url, refusing it with a 400 once it exceeds `max_size` bytes"""
+    async with http.session("media").get(url) as response:
+        response.raise_for_status()
+        if response.content_length is not None and response.content_length > max_size:
+            raise HTTPBadRequest(reason=f"Audio larger than {max_size} bytes")
+        data = bytearray()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            data.extend(chunk)
+            if len(data) > max_size:
+                raise HTTPBadRequest(reason=f"Audio larger than {max_size} bytes")
+    return bytes(data)
+
+
+async def audiotrack_feed_handler(url: str, mode: EmbeddingMode = "fft"):
     """Returns the 10 KNN for the given track url"""
-    namespace = q("namespace") == "audio_tracks"
-    async with ClientSession() as session:
-        async with session.get(url) as response:
-            data = await response.read()
-            normalized_embedding, _ = mp3_to_vect(data)
-            results = await llm.pinecone.query(
-                expr=namespace.query, vector=normalized_embedding, topK=10
-            )
-            matches = results.matches
-            return sorted(matches, key=lambda x: x.score, reverse=True)
+    url_key = cache.alias_key(f"url:{url}", mode)
+    cached = await cache.get(url_key)
+    if cached is None:
+        data = await download(url)
+        cached = await cache.fetch(
+            [cache.content_key(data, mode), url_key],
+            lambda: engine.mp3_to_vect(data, mode),
+        )
+    normalized_embedding, _ = cached
+    return await audio_knn(normalized_embedding, topK=10)
 
 
 async def youtube_search(id: str):
-    async with ClientSession() as session:
-        async with session.get(f"https://www.youtube.com/watch?v={id}") as response:
-            data = await response.text()
-            related_videos = re.findall(r"watch\?v=(.{11})", data)
-            return related_videos
+    async with http.session().get(f"https://www.youtube.com/watch?v={id}") as response:
+        data = await response.text()
+        related_videos = re.findall(r"watch\?v=(.{11})", data)
+        return related_videos
 
 
 async def ingest_music_vector(vectors: List[Vector], url: str):
-    return await llm.pinecone.upsert(
-        [
-            Embedding(values=v, metadata={"url": url, "namespace": "hhmc"})
-            for v in vectors
-        ]
+    return await (
+        await upserts.put(
+            [
+                Embedding(values=v, metadata={"url": url, "namespace": "hhmc"})
+                for v in vectors
+            ]
+        )
     )
 
 
@@ -0,0 +1,240 @@
+import asyncio
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any, Deque, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+from urllib.robotparser import RobotFileParser
+
+from aiofauna import setup_logging
+from aiohttp import ClientSession
+
+logger = setup_logging(__name__)
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a `Retry-After` header, given either as seconds or as an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class Host(object):
+    """
+    Politeness state of a single host: a token bucket refilled at `rate` requests per
+    second up to `burst`, at most `concurrency` requests in flight, and a backoff deadline
+    set when the host throttles us
+    """
+
+    def __init__(self, name: str, concurrency: int, rate: float, burst: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.base_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.refilled = time.monotonic()
+        self.active = 0
+        self.until = 0.0
+        self.strikes = 0
+        self.throttled = 0
+        self.queue: Deque[Any] = deque()
+        self.robots: Optional[RobotFileParser] = None
+        self.loading = False
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def wait(self, now: float) -> Optional[float]:
+        """Seconds until the host may take its next request, `None` while nothing but a release can free it"""
+        if not self.queue or self.loading or self.active >= self.concurrency:
+            return None
+        self._refill(now)
+        return max(self.until - now, (1 - self.tokens) / self.rate, 0)
+
+    def take(self) -> Any:
+        self.tokens -= 1
+        self.active += 1
+        return self.queue.popleft()
+
+    def throttle(self, delay: Optional[float], max_backoff: float, min_rate: float) -> bool:
+        """Backs off for `delay` seconds (exponential when the host did not say) and halves the rate, unless already backing off"""
+        now = time.monotonic()
+        self.throttled += 1
+        if now < self.until:
+            # the other requests of the same burst, the host already counts as backing off
+            if delay is not None:
+                self.until = max(self.until, now + min(delay, max_backoff))
+            return False
+        self.strikes += 1
+        if delay is None:
+            delay = min(2**self.strikes, max_backoff)
+        self.until = now + min(delay, max_backoff)
+        self.rate = max(self.rate / 2, min_rate)
+        self.tokens = min(self.tokens, 0)
+        return True
+
+    def recover(self):
+        """A request went through, the rate climbs back towards the base one step at a time"""
+        self.strikes = 0
+        self.rate = min(self.base_rate, self.rate + self.base_rate / 10)
+
+
+class HostScheduler(object):
+    """
+    Hands out queued crawl items host by host instead of first in first out. Each host gets
+    at most `concurrency` requests in flight and `rate` requests per second (bursts of
+    `burst`); with `robots` set its robots.txt rules apply and its `Crawl-delay` lowers
+    the rate. A host that
+    answers 429 or 503 waits for its `Retry-After` (or an exponential backoff) and has its
+    rate halved until it recovers, and while it waits the workers serve the other hosts.
+    `put` waits while `max_queued` items are queued across all hosts.
+    """
+
+    def __init__(
+        self,
+        session: ClientSession,
+        concurrency: int = 4,
+        rate: float = 5.0,
+        burst: int = 10,
+        max_backoff: float = 300,
+        min_rate: float = 0.1,
+        robots: bool = False,
+        max_queued: int = 1000,
+    ):
+        self.session = session
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_backoff = max_backoff
+        self.min_rate = min_rate
+        self.robots = robots
+        self.max_queued = max_queued
+        self.hosts: Dict[str, Host] = {}
+        self.queued = 0
+        self.active = 0
+        self.closed = False
+        self._changed: Optional[asyncio.Event] = None
+        self._room: Optional[asyncio.Event] = None
+        self._tasks: set = set()
+
+    @property
+    def changed(self) -> asyncio.Event:
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        return self._changed
+
+    @property
+    def room(self) -> asyncio.Event:
+        if self._room is None:
+            self._room = asyncio.Event()
+        return self._room
+
+    def host(self, url: str) -> Host:
+        name = urlsplit(url).netloc
+        if name not in self.hosts:
+            host = self.hosts[name] = Host(name, self.concurrency, self.rate, self.burst)
+            if self.robots:
+                host.loading = True
+                task = asyncio.create_task(self._load_robots(host, url))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        return self.hosts[name]
+
+    async def _load_robots(self, host: Host, url: str):
+        parts = urlsplit(url)
+        parser = RobotFileParser()
+        try:
+            async with self.session.get(f"{parts.scheme}://{parts.netloc}/robots.txt") as response:
+                if response.status == 200:
+                    parser.parse((await response.text()).splitlines())
+                    host.robots = parser
+                    delay = parser.crawl_delay("*")
+                    if delay:
+                        host.base_rate = host.rate = min(host.rate, 1 / float(delay))
+                        host.burst = 1
+                        host.tokens = min(host.tokens, 1)
+                        logger.info("Crawl-delay of %s for %s", delay, host.name)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning("Could not read robots.txt of %s: %s", host.name, exc)
+        finally:
+            host.loading = False
+            self.changed.set()
+
+    def allowed(self, url: str) -> bool:
+        host = self.hosts.get(urlsplit(url).netloc)
+        return host is None or host.robots is None or host.robots.can_fetch("*", url)
+
+    async def put(self, url: str, item: Any):
+        while self.queued >= self.max_queued:
+            self.room.clear()
+            await self.room.wait()
+        self.host(url).queue.append(item)
+        self.queued += 1
+        self.changed.set()
+
+    def retry(self, host: Host, item: Any):
+        """Puts back an item the host turned away, first in line once the host takes requests again"""
+        host.queue.appendleft(item)
+        self.queued += 1
+        self.changed.set()
+
+    def close(self):
+        """No more items will be put, `get` returns `None` once everything was handed out and released"""
+        self.closed = True
+        self.changed.set()
+
+    async def get(self) -> Optional[Tuple[Host, Any]]:
+        """Waits for the next item of any host that may take a request now"""
+        while True:
+            now = time.monotonic()
+            soonest: Optional[float] = None
+            # rotate so hosts that are always ready do not starve the others
+            for name in list(self.hosts):
+                host = self.hosts[name]
+                wait = host.wait(now)
+                if wait is None:
+                    continue
+                if wait <= 0:
+                    self.hosts[name] = self.hosts.pop(name)
+                    self.queued -= 1
+                    self.active += 1
+                    self.room.set()
+                    return host, host.take()
+                soonest = wait if soonest is None else min(soonest, wait)
+            if self.closed and self.queued == 0 and self.active == 0:
+                self.changed.set()  # wakes the sibling workers so they finish too
+                return None
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout=soonest)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, host: Host):
+        host.active -= 1
+        self.active -= 1
+        self.changed.set()
+
+    def throttle(self, host: Host, delay: Optional[float]):
+        if host.throttle(delay, self.max_backoff, self.min_rate):
+            logger.warning("%s throttled us, backing off (rate %.2f/s)", host.name, host.rate)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            name: {
+                "queued": len(host.queue),
+                "active": host.active,
+                "rate": host.rate,
+                "throttled": host.throttled,
+            }
+            for name, host in self.hosts.items()
+        }
@@ -0,0 +1,316 @@
+import asyncio
+import base64
+import fcntl
+import json
+import os
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+from aiofauna import setup_logging
+from aiofauna.helpers import ThreadPoolExecutor, asyncify
+from cheapcone import Embedding, MetaData, QueryBuilder, QueryMatch, Vector
+
+from .clients import pinecone
+from .utils import EMBEDDING_DIM
+
+logger = setup_logging(__name__)
+
+NAMESPACE = (QueryBuilder()("namespace") == "audio_tracks").query
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms)
+
+
+class VectorIndex(object):
+    """
+    In-process cosine index for the `audio_tracks` namespace, used as a hot tier in front of
+    Pinecone and as an offline stand-in for it. Small sets are scanned with a single matrix
+    product, past `ivf_threshold` vectors an inverted file (spherical k-means) limits the scan
+    to the `nprobe` closest lists. When `path` is set every upsert is appended to a log that
+    the other workers replay before answering, so all of them see the same tracks. Once it
+    holds more than `compact_ratio` entries per track the log is rewritten with only the
+    latest entry of each.
+
+    The index only starts complete after `bootstrap` copied every track of Pinecone into
+    it, which is recorded in the log, until then `audio_knn` merges in Pinecone results.
+    """
+
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        dim: int = EMBEDDING_DIM,
+        ivf_threshold: int = 20000,
+        nprobe: int = 8,
+        compact_ratio: float = 2.0,
+    ):
+        self.path = path
+        self.dim = dim
+        self.ivf_threshold = ivf_threshold
+        self.nprobe = nprobe
+        self.compact_ratio = compact_ratio
+        self.complete = False
+        self.size = 0
+        self.vectors = np.zeros((1024, dim), dtype=np.float32)
+        self.metadata: List[MetaData] = []
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.centroids: Optional[np.ndarray] = None
+        self.lists = np.zeros(1024, dtype=np.int32)
+        self.trained_size = 0
+        self.offset = 0
+        self.entries = 0
+        self.inode: Optional[int] = None
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def key(metadata: MetaData) -> str:
+        return str(metadata.get("url") or metadata.get("id") or metadata.get("ref"))
+
+    def _add(self, id: str, vector: np.ndarray, metadata: MetaData):
+        row = self.rows.get(id)
+        if row is None:
+            row = self.size
+            if row == len(self.vectors):
+                self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+                self.lists = np.concatenate([self.lists, np.zeros_like(self.lists)])
+            self.size += 1
+            self.ids.append(id)
+            self.metadata.append(metadata)
+            self.rows[id] = row
+        else:
+            self.metadata[row] = metadata
+        self.vectors[row] = normalize(vector)
+        if self.centroids is not None:
+            self.lists[row] = np.argmax(self.centroids @ self.vectors[row])
+
+    def _train(self, iterations: int = 10):
+        """Spherical k-means over a sample of the vectors, then assigns every row to a list"""
+        vectors = self.vectors[: self.size]
+        nlist = max(1, int(np.sqrt(self.size)))
+        rng = np.random.default_rng(0)
+        sample = vectors[rng.choice(self.size, min(self.size, nlist * 64), replace=False)]
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            filled = np.bincount(assignments, minlength=nlist) > 0
+            centroids[filled] = normalize(sums[filled])
+        for start in range(0, self.size, 8192):
+            block = vectors[start : start + 8192]
+            self.lists[start : start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        self.centroids = centroids
+        self.trained_size = self.size
+
+    def _sync(self):
+        """Replays the entries other workers appended to the log since the last sync"""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as f:
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self.inode:
+                # compacted by another worker, replaying it again only rewrites the same rows
+                self.inode, self.offset, self.entries = inode, 0, 0
+            f.seek(self.offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                self.offset += len(line)
+                self.entries += 1
+                entry = json.loads(line)
+                if entry.get("complete"):
+                    self.complete = True
+                    continue
+                vector = np.frombuffer(base64.b64decode(entry["vector"]), dtype=np.float32)
+                self._add(entry["id"], vector, entry["metadata"])
+
+    @staticmethod
+    def _entry(id: str, vector: np.ndarray, metadata: MetaData) -> dict:
+        return {
+            "id": id,
+            "metadata": metadata,
+            "vector": base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode(),
+        }
+
+    def _append(self, entries: List[dict]):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)  # type: ignore
+        while True:
+            with open(self.path, "ab") as f:  # type: ignore
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(f.fileno()).st_ino != os.stat(self.path).st_ino:  # type: ignore
+                        continue  # compacted while we waited for the lock, append to the new log
+                    for entry in entries:
+                        f.write(json.dumps(entry, default=str).encode() + b"\n")
+                    return
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _compact(self):
+        """Rewrites the log with the latest entry of every track, under the same lock as the appends"""
+        if self.path is None or self.entries <= max(self.compact_ratio * self.size, 1024):
+            return
+        with open(self.path, "ab") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                if os.fstat(f.fileno()).st_ino != os.stat(self.path).st_ino:
+                    return  # another worker compacted it already
+                self._sync()
+                temporary = f"{self.path}.{os.getpid()}.tmp"
+                with open(temporary, "wb") as out:
+                    for row, id in enumerate(self.ids):
+                        entry = self._entry(id, self.vectors[row], self.metadata[row])
+                        out.write(json.dumps(entry, default=str).encode() + b"\n")
+                    if self.complete:
+                        out.write(b'{"complete": true}\n')
+                os.replace(temporary, self.path)
+                self.inode = os.stat(self.path).st_ino
+                self.offset = os.path.getsize(self.path)
+                self.entries = self.size + self.complete
+                logger.info("Compacted the vector index log to %s tracks", self.size)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @asyncify
+    def upsert(self, embeddings: List[Embedding]):
+        """Adds or replaces the given embeddings, keyed by their track url"""
+        with self.lock:
+            if self.path is not None:
+                self._append(
+                    [
+                        self._entry(
+                            self.key(embedding.metadata), embedding.values, embedding.metadata
+                        )
+                        for embedding in embeddings
+                    ]
+                )
+                self._sync()
+                self._compact()
+            else:
+                for embedding in embeddings:
+                    self._add(
+                        self.key(embedding.metadata),
+                        np.asarray(embedding.values, dtype=np.float32),
+                        embedding.metadata,
+                    )
+
+    @asyncify
+    def refresh(self):
+        """Replays what the other workers appended to the log"""
+        with self.lock:
+            self._sync()
+
+    @asyncify
+    def _seed(self, matches: List[dict], complete: bool):
+        with self.lock:
+            self._sync()
+            if self.complete:
+                return
+            # tracks ingested here since the bootstrap started are newer than Pinecone's copy
+            matches = [
+                match for match in matches if self.key(match["metadata"]) not in self.rows
+            ]
+            if self.path is None:
+                for match in matches:
+                    vector = np.asarray(match["values"], dtype=np.float32)
+                    self._add(self.key(match["metadata"]), vector, match["metadata"])
+                self.complete = complete
+                return
+            entries = [
+                self._entry(self.key(match["metadata"]), match["values"], match["metadata"])
+                for match in matches
+            ]
+            self._append(entries + ([{"complete": True}] if complete else []))
+            self._sync()
+
+    async def bootstrap(self, limit: int = 1000):
+        """
+        Copies the tracks of Pinecone into the index, once for all the workers sharing the
+        log. Pinecone returns at most `limit` vectors with their values per query, so the
+        index is only marked complete when it holds fewer than that.
+        """
+        await self.refresh()
+        if self.complete:
+            return
+        try:
+            response = await pinecone.post(
+                "/query",
+                {
+                    "vector": [1.0] * self.dim,
+                    "topK": limit,
+                    "filter": NAMESPACE,
+                    "includeValues": True,
+                    "includeMetadata": True,
+                },
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Could not bootstrap the vector index: %s", exc)
+            return
+        matches = response.get("matches", [])
+        await self._seed(matches, complete=len(matches) < limit)
+        logger.info(
+            "Bootstrapped the vector index with %s tracks (%s)",
+            len(matches),
+            "complete" if self.complete else "Pinecone results are still merged in",
+        )
+
+    @asyncify
+    def query(self, vector: Vector, topK: int = 10) -> List[QueryMatch]:
+        """Returns the `topK` closest tracks by cosine similarity, best first"""
+        with self.lock:
+            self._sync()
+            self._compact()
+            if self.size >= self.ivf_threshold and self.size >= 2 * self.trained_size:
+                self._train()
+            query = normalize(np.asarray(vector, dtype=np.float32))
+            if self.centroids is not None:
+                probes = np.argsort(self.centroids @ query)[-self.nprobe :]
+                candidates = np.flatnonzero(np.isin(self.lists[: self.size], probes))
+                scores = self.vectors[candidates] @ query
+            else:
+                candidates = np.arange(self.size)
+                scores = self.vectors[: self.size] @ query
+            k = min(topK, len(candidates))
+            if k == 0:
+                return []
+            best = np.argpartition(-scores, k - 1)[:k]
+            best = best[np.argsort(-scores[best])]
+            return [
+                QueryMatch(
+                    id=self.ids[candidates[i]],
+                    score=float(scores[i]),
+                    metadata=self.metadata[candidates[i]],
+                )
+                for i in best
+            ]
+
+
+index = VectorIndex(
+    path=os.environ.get("VECTOR_INDEX_PATH", "/tmp/hhmc-index/audio_tracks.log")
+)
+fallback = os.environ.get("VECTOR_INDEX_FALLBACK", "1") == "1"
+
+
+async def audio_knn(vector: Vector, topK: int = 10) -> List[QueryMatch]:
+    """
+    Returns the `topK` closest audio tracks from the local index. Until the index holds
+    every track of Pinecone (see `VectorIndex.bootstrap`) Pinecone is queried too, when the
+    fallback is enabled, and both results are merged
+    """
+    if index.complete or not fallback:
+        return await index.query(vector, topK=topK)
+    local, results = await asyncio.gather(
+        index.query(vector, topK=topK),
+        pinecone.query(expr=NAMESPACE, vector=vector, topK=topK),
+    )
+    matches: Dict[str, QueryMatch] = {}
+    for match in [*results.matches, *local]:
+        key = VectorIndex.key(match.metadata)
+        if key not in matches or match.score > matches[key].score:
+            matches[key] = match
+    return sorted(matches.values(), key=lambda x: x.score, reverse=True)[:topK]
@@ -0,0 +1,252 @@
+import asyncio
+import io
+import os
+import zipfile
+from dataclasses import dataclass
+from typing import AsyncIterator, List, Optional
+
+from aiofauna import Request, setup_logging
+from aiohttp import BodyPartReader
+from aiohttp.web_exceptions import HTTPServiceUnavailable
+from cheapcone import Embedding, Vector
+
+from .cache import cache
+from .index import index
+from .pipeline import batched, stage
+from .queues import upserts
+from .schemas import AudioTrack
+from .storage import storage
+from .utils import EmbeddingMode, engine
+
+logger = setup_logging(__name__)
+
+ARCHIVE_MAX_ENTRY = int(os.environ.get("ARCHIVE_MAX_ENTRY", 50 * 2**20))
+
+
+@dataclass
+class BulkItem:
+    """A single track flowing through the bulk ingestion pipeline"""
+
+    name: str
+    key: str
+    data: Optional[bytes] = None
+    vector: Optional[Vector] = None
+    duration: float = 0
+    track: Optional[AudioTrack] = None
+    error: Optional[str] = None
+
+    def skipped(self) -> bool:
+        return self.error is not None
+
+    def fail(self, exc: Exception):
+        logger.error("%s failed: %s", self.name, exc)
+        self.error = str(exc) or exc.__class__.__name__
+
+    def result(self) -> dict:
+        if self.error is not None:
+            return {"name": self.name, "status": "error", "error": self.error}
+        return {"name": self.name, "status": "ok", "track": self.track.dict()}  # type: ignore
+
+
+Inbox = "asyncio.Queue[Optional[BulkItem]]"
+
+
+class BulkIngestion(object):
+    """
+    Staged pipeline for onboarding many tracks at once: fetch (or store) the audio with
+    bounded concurrency, embed it on the process pool, save the `AudioTrack`s in batches
+    and queue their vectors, every stage running concurrently on its own queue.
+    Per-item results are yielded as soon as an item leaves the last stage.
+    """
+
+    def __init__(
+        self,
+        user: str,
+        playlist: str,
+        mode: EmbeddingMode = "fft",
+        fetch_concurrency: int = 8,
+        batch_size: int = 25,
+        batch_interval: float = 1.0,
+    ):
+        self.user = user
+        self.playlist = playlist
+        self.mode = mode
+        self.fetch_concurrency = fetch_concurrency
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.total = 0
+        self.done = 0
+
+    @property
+    def prefix(self) -> str:
+        return f"{self.user}/{self.playlist}/"
+
+    def owns(self, key: str) -> bool:
+        """Whether an existing key belongs to the user and playlist being ingested into"""
+        return key.startswith(self.prefix) and ".." not in key.split("/")
+
+    def item(self, name: str, data: Optional[bytes] = None) -> BulkItem:
+        """
+        Builds an item from an uploaded file, or from an existing key when `data` is None.
+        Keys outside the `user/playlist/` prefix fail, nobody ingests another user's objects.
+        """
+        if data is None:
+            item = BulkItem(name=name.rsplit("/", 1)[-1], key=name)
+            if not self.owns(name):
+                item.fail(PermissionError(f"{name} is not under {self.prefix}"))
+            return item
+        return BulkItem(name=name, key=f"{self.user}/{self.playlist}/{name}", data=data)
+
+    async def fetch(self, item: BulkItem):
+        if item.data is None:
+            item.data = await storage.get(item.key)
+        else:
+            await storage.put(item.key, item.data)
+
+    async def embed(self, item: BulkItem):
+        async def compute():
+            while True:
+                try:
+                    return await engine.mp3_to_vect(item.data, self.mode)  # type: ignore
+                except HTTPServiceUnavailable:
+                    await asyncio.sleep(1)
+
+        item.vector, item.duration = await cache.fetch(
+            [cache.content_key(item.data, self.mode)], compute  # type: ignore
+        )
+        item.data = None
+
+    async def store(self, inbox: Inbox, outbox: Inbox):
+        """Saves the tracks and queues their vectors in batches of `batch_size`"""
+        await batched(inbox, outbox, self._store, self.batch_size, self.batch_interval)
+
+    async def _store(self, batch: List[BulkItem]):
+        try:
+            tracks = await AudioTrack.save_many(
+                [
+                    AudioTrack(
+                        playlist=self.playlist,
+                        url=storage.url(item.key),  # type: ignore
+                        user=self.user,
+                        duration=item.duration,  # type: ignore
+                        title=item.name,
+                    )
+                    for item in batch
+                ]
+            )
+            embeddings = [
+                Embedding(values=item.vector, metadata=track.dict())  # type: ignore
+                for item, track in zip(batch, tracks)
+            ]
+            await index.upsert(embeddings)
+            await (await upserts.put(embeddings))
+            for item, track in zip(batch, tracks):
+                item.track = track
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Batch of %s tracks failed: %s", len(batch), exc)
+            for item in batch:
+                item.error = str(exc) or exc.__class__.__name__
+
+    async def run(self, sources: AsyncIterator[BulkItem]) -> AsyncIterator[dict]:
+        """Runs every stage over the given items, yielding a result per item and a final summary"""
+        size = 2 * self.fetch_concurrency
+        fetched, embedded, stored = (asyncio.Queue(size) for _ in range(3))
+        incoming: Inbox = asyncio.Queue(size)
+        feeding = True
+
+        async def feed():
+            nonlocal feeding
+            try:
+                async for item in sources:
+                    self.total += 1
+                    await incoming.put(item)
+            finally:
+                feeding = False
+                await incoming.put(None)
+
+        tasks = [
+            asyncio.create_task(feed()),
+            asyncio.create_task(stage(incoming, fetched, self.fetch, self.fetch_concurrency)),
+            asyncio.create_task(stage(fetched, embedded, self.embed, engine.max_workers)),
+            asyncio.create_task(self.store(embedded, stored)),
+        ]
+        try:
+            while (item := await stored.get()) is not None:
+                self.done += 1
+                yield {
+                    **item.result(),
+                    "progress": {
+                        "done": self.done,
+                        "total": None if feeding else self.total,
+                    },
+                }
+            await asyncio.gather(*tasks)
+            yield {"status": "done", "total": self.total, "done": self.done}
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def read_entry(archive: zipfile.ZipFile, entry: zipfile.ZipInfo, max_size: int) -> bytes:
+    # The sizes in the archive may lie, only what was actually inflated counts
+    with archive.open(entry) as file:
+        data = file.read(max_size + 1)
+    if len(data) > max_size:
+        raise ValueError(f"Larger than {max_size} bytes uncompressed")
+    return data
+
+
+async def archive_items(
+    ingestion: BulkIngestion, name: str, data: bytes, max_entry: int = ARCHIVE_MAX_ENTRY
+) -> AsyncIterator[BulkItem]:
+    """
+    Expands a zip archive into one item per audio file, inflating one entry at a time in a
+    thread. Entries over `max_entry` bytes uncompressed fail on their own.
+    """
+    loop = asyncio.get_running_loop()
+    archive = await loop.run_in_executor(None, zipfile.ZipFile, io.BytesIO(data))
+    with archive:
+        for entry in archive.infolist():
+            if entry.is_dir() or not entry.filename.lower().endswith(".mp3"):
+                continue
+            filename = entry.filename.rsplit("/", 1)[-1]
+            try:
+                content = await loop.run_in_executor(
+                    None, read_entry, archive, entry, max_entry
+                )
+            except Exception as exc:  # pylint: disable=broad-except
+                item = ingestion.item(filename, b"")
+                item.fail(exc)
+                yield item
+                continue
+            yield ingestion.item(filename, content)
+        logger.info("Expanded %s", name)
+
+
+async def request_items(
+    ingestion: BulkIngestion, request: Request
+) -> AsyncIterator[BulkItem]:
+    """
+    Yields the items of a bulk request as the body is read: a JSON body with a list of
+    storage `keys`, or a multipart body with any number of mp3 or zip files and an
+    optional `keys` field holding one storage key per line. Keys must be under the
+    `user/playlist/` prefix of the ingestion.
+    """
+    if request.content_type == "application/json":
+        for key in (await request.json()).get("keys", []):
+            yield ingestion.item(key)
+        return
+    reader = await request.multipart()
+    async for part in reader:
+        if not isinstance(part, BodyPartReader):
+            continue
+        if part.name == "keys":
+            for key in (await part.text()).split():
+                yield ingestion.item(key)
+        elif part.filename:
+            data = bytes(await part.read())
+            if part.filename.lower().endswith(".zip"):
+                async for item in archive_items(ingestion, part.filename, data):
+                    yield item
+            else:
+                yield ingestion.item(part.filename, data)
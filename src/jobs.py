@@ -0,0 +1,501 @@
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from dataclasses import asdict, dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+from uuid import uuid4
+
+from aiofauna import JSONEncoder, setup_logging
+from aiofauna.helpers import ThreadPoolExecutor, asyncify
+
+try:
+    from redis import asyncio as aioredis
+except ImportError:  # the SQLite store is enough for local runs
+    aioredis = None
+
+logger = setup_logging(__name__)
+
+# Pops a queued job and leases it in one step, so no job is ever on neither the queue nor
+# the running set
+CLAIM_SCRIPT = """
+local id = redis.call("LPOP", KEYS[1])
+if not id then
+    return nil
+end
+redis.call("ZADD", KEYS[2], ARGV[2], id)
+local job = ARGV[1] .. ":" .. id
+redis.call("HINCRBY", job, "attempts", 1)
+redis.call("HSET", job, "status", "running", "updated", ARGV[3])
+return id
+"""
+
+# Takes a job whose lease expired off the running set and requeues or fails it in one step
+REQUEUE_SCRIPT = """
+if redis.call("ZREM", KEYS[2], ARGV[2]) == 0 then
+    return 0
+end
+local job = ARGV[1] .. ":" .. ARGV[2]
+if tonumber(redis.call("HGET", job, "attempts") or "0") >= tonumber(ARGV[3]) then
+    redis.call("HSET", job, "status", "failed", "error", "Worker lost")
+else
+    redis.call("HSET", job, "status", "queued")
+    redis.call("RPUSH", KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+Report = Callable[[Any], Awaitable[None]]
+Handler = Callable[[Dict[str, Any], Report], Awaitable[Any]]
+
+handlers: Dict[str, Handler] = {}
+
+
+def task(kind: str):
+    """Registers the decorated coroutine as the handler of the jobs of the given kind"""
+
+    def decorator(func: Handler) -> Handler:
+        handlers[kind] = func
+        return func
+
+    return decorator
+
+
+@dataclass
+class Job:
+    """A unit of background work, `status` is queued, running, done, failed or cancelled"""
+
+    kind: str
+    payload: Dict[str, Any]
+    id: str = field(default_factory=lambda: str(uuid4()))
+    status: str = "queued"
+    progress: Any = None
+    result: Any = None
+    error: Optional[str] = None
+    attempts: int = 0
+    cancelled: bool = False
+    created: float = field(default_factory=time.time)
+    updated: float = field(default_factory=time.time)
+
+    def dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+def dumps(value: Any) -> str:
+    return json.dumps(value, cls=JSONEncoder)
+
+
+class JobStore(ABC):
+    """
+    Durable queue of jobs. A claimed job is leased for `lease` seconds and the worker keeps
+    renewing the lease while it runs, so the jobs of a worker that died are handed out
+    again, at most `max_attempts` times.
+    """
+
+    lease: float = 60
+    max_attempts: int = 3
+
+    @abstractmethod
+    async def enqueue(self, kind: str, payload: Dict[str, Any]) -> Job:
+        ...
+
+    @abstractmethod
+    async def get(self, id: str) -> Optional[Job]:
+        ...
+
+    @abstractmethod
+    async def cancel(self, id: str) -> Optional[Job]:
+        """Flags the job as cancelled, a queued job is never run and a running one is stopped"""
+
+    @abstractmethod
+    async def claim(self, timeout: float) -> Optional[Job]:
+        """Waits up to `timeout` seconds for a queued job and marks it as running"""
+
+    @abstractmethod
+    async def heartbeat(self, job: Job) -> bool:
+        """Renews the lease of a running job, returns False once it was cancelled"""
+
+    @abstractmethod
+    async def finish(self, job: Job):
+        """Stores the final status, result and error of the job"""
+
+    async def close(self):
+        pass
+
+
+class SQLiteJobStore(JobStore):
+    """Single file job store for local runs, shared by every process on the host"""
+
+    # One thread owns the connection so claim transactions never interleave in a process
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def __init__(self, path: str, poll_interval: float = 0.5):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._db = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False, timeout=30
+            )
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY, kind TEXT, payload TEXT, status TEXT,
+                    progress TEXT, result TEXT, error TEXT, attempts INTEGER,
+                    cancelled INTEGER, created REAL, updated REAL, deadline REAL
+                )"""
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)"
+            )
+        return self._db
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Job:
+        return Job(
+            id=row["id"],
+            kind=row["kind"],
+            payload=json.loads(row["payload"]),
+            status=row["status"],
+            progress=json.loads(row["progress"]),
+            result=json.loads(row["result"]),
+            error=row["error"],
+            attempts=row["attempts"],
+            cancelled=bool(row["cancelled"]),
+            created=row["created"],
+            updated=row["updated"],
+        )
+
+    @asyncify
+    def enqueue(self, kind: str, payload: Dict[str, Any]) -> Job:
+        job = Job(kind=kind, payload=payload)
+        self.db.execute(
+            "INSERT INTO jobs VALUES (?, ?, ?, ?, 'null', 'null', NULL, 0, 0, ?, ?, 0)",
+            (job.id, kind, dumps(payload), job.status, job.created, job.updated),
+        )
+        return job
+
+    @asyncify
+    def get(self, id: str) -> Optional[Job]:
+        row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    @asyncify
+    def cancel(self, id: str) -> Optional[Job]:
+        self.db.execute(
+            """UPDATE jobs SET cancelled = 1, updated = ?,
+               status = CASE status WHEN 'queued' THEN 'cancelled' ELSE status END
+               WHERE id = ?""",
+            (time.time(), id),
+        )
+        row = self.db.execute("SELECT * FROM jobs WHERE id = ?", (id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    @asyncify
+    def _claim(self) -> Optional[Job]:
+        now = time.time()
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            # Jobs whose worker stopped renewing the lease go back to the queue
+            db.execute(
+                """UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+                   error = CASE WHEN attempts >= ? THEN 'Worker lost' ELSE error END
+                   WHERE status = 'running' AND deadline < ?""",
+                (self.max_attempts, self.max_attempts, now),
+            )
+            row = db.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is None:
+                db.execute("COMMIT")
+                return None
+            db.execute(
+                """UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                   updated = ?, deadline = ? WHERE id = ?""",
+                (now, now + self.lease, row["id"]),
+            )
+            db.execute("COMMIT")
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        job = self._job(row)
+        job.status = "running"
+        job.attempts += 1
+        return job
+
+    async def claim(self, timeout: float) -> Optional[Job]:
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await self._claim()
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            await asyncio.sleep(self.poll_interval)
+
+    @asyncify
+    def heartbeat(self, job: Job) -> bool:
+        now = time.time()
+        self.db.execute(
+            "UPDATE jobs SET progress = ?, updated = ?, deadline = ? WHERE id = ?",
+            (dumps(job.progress), now, now + self.lease, job.id),
+        )
+        row = self.db.execute("SELECT cancelled FROM jobs WHERE id = ?", (job.id,)).fetchone()
+        return row is not None and not row["cancelled"]
+
+    @asyncify
+    def finish(self, job: Job):
+        self.db.execute(
+            """UPDATE jobs SET status = ?, progress = ?, result = ?, error = ?, updated = ?
+               WHERE id = ?""",
+            (
+                job.status,
+                dumps(job.progress),
+                dumps(job.result),
+                job.error,
+                time.time(),
+                job.id,
+            ),
+        )
+
+
+class RedisJobStore(JobStore):
+    """
+    Redis job store: every job is a hash, queued ids wait in a list and running ids sit in
+    a sorted set scored by their lease deadline. Jobs move between the two with Lua scripts
+    so a worker dying halfway cannot lose one. Finished jobs expire after `ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        prefix: str = "hhmc:jobs",
+        ttl: int = 7 * 86400,
+        poll_interval: float = 0.5,
+    ):
+        if aioredis is None:
+            raise RuntimeError("The redis package is required for the Redis job store")
+        self.url = url
+        self.prefix = prefix
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self._redis: Optional["aioredis.Redis"] = None
+        self._claim_script: Any = None
+        self._requeue_script: Any = None
+
+    @property
+    def redis(self) -> "aioredis.Redis":
+        if self._redis is None:
+            self._redis = aioredis.from_url(self.url, decode_responses=True)
+            self._claim_script = self._redis.register_script(CLAIM_SCRIPT)
+            self._requeue_script = self._redis.register_script(REQUEUE_SCRIPT)
+        return self._redis
+
+    def _key(self, id: str) -> str:
+        return f"{self.prefix}:{id}"
+
+    @property
+    def _keys(self) -> List[str]:
+        return [f"{self.prefix}:queue", f"{self.prefix}:running"]
+
+    @staticmethod
+    def _job(data: Dict[str, str]) -> Job:
+        return Job(
+            id=data["id"],
+            kind=data["kind"],
+            payload=json.loads(data["payload"]),
+            status=data["status"],
+            progress=json.loads(data.get("progress", "null")),
+            result=json.loads(data.get("result", "null")),
+            error=data.get("error") or None,
+            attempts=int(data.get("attempts", 0)),
+            cancelled=data.get("cancelled") == "1",
+            created=float(data["created"]),
+            updated=float(data["updated"]),
+        )
+
+    async def enqueue(self, kind: str, payload: Dict[str, Any]) -> Job:
+        job = Job(kind=kind, payload=payload)
+        mapping = {
+            "id": job.id,
+            "kind": kind,
+            "payload": dumps(payload),
+            "status": job.status,
+            "attempts": 0,
+            "cancelled": "0",
+            "created": job.created,
+            "updated": job.updated,
+        }
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._key(job.id), mapping=mapping)  # type: ignore
+            pipe.rpush(f"{self.prefix}:queue", job.id)
+            await pipe.execute()
+        return job
+
+    async def get(self, id: str) -> Optional[Job]:
+        data = await self.redis.hgetall(self._key(id))
+        return self._job(data) if data else None
+
+    async def cancel(self, id: str) -> Optional[Job]:
+        job = await self.get(id)
+        if job is None:
+            return None
+        mapping: Dict[str, Any] = {"cancelled": "1", "updated": time.time()}
+        if job.status == "queued":
+            mapping["status"] = "cancelled"
+            await self.redis.lrem(f"{self.prefix}:queue", 0, id)
+        await self.redis.hset(self._key(id), mapping=mapping)  # type: ignore
+        return await self.get(id)
+
+    async def _requeue_expired(self):
+        for id in await self.redis.zrangebyscore(f"{self.prefix}:running", 0, time.time()):
+            # a no-op when another worker got to it first
+            await self._requeue_script(
+                keys=self._keys, args=[self.prefix, id, self.max_attempts]
+            )
+
+    async def _claim(self) -> Optional[Job]:
+        await self._requeue_expired()
+        now = time.time()
+        id = await self._claim_script(
+            keys=self._keys, args=[self.prefix, now + self.lease, now]
+        )
+        return await self.get(id) if id is not None else None
+
+    async def claim(self, timeout: float) -> Optional[Job]:
+        deadline = time.monotonic() + timeout
+        while True:
+            job = await self._claim()
+            if job is not None or time.monotonic() >= deadline:
+                return job
+            await asyncio.sleep(self.poll_interval)
+
+    async def heartbeat(self, job: Job) -> bool:
+        now = time.time()
+        await self.redis.zadd(f"{self.prefix}:running", {job.id: now + self.lease}, xx=True)
+        await self.redis.hset(
+            self._key(job.id), mapping={"progress": dumps(job.progress), "updated": now}
+        )
+        return await self.redis.hget(self._key(job.id), "cancelled") != "1"
+
+    async def finish(self, job: Job):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.zrem(f"{self.prefix}:running", job.id)
+            pipe.hset(
+                self._key(job.id),
+                mapping={
+                    "status": job.status,
+                    "progress": dumps(job.progress),
+                    "result": dumps(job.result),
+                    "error": job.error or "",
+                    "updated": time.time(),
+                },
+            )
+            pipe.expire(self._key(job.id), self.ttl)
+            await pipe.execute()
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.close()
+
+
+class Worker(object):
+    """
+    Runs claimed jobs with up to `concurrency` of them at a time. While a job runs its
+    lease is renewed every `heartbeat` seconds, which also stores its progress and stops
+    the job as soon as it is cancelled.
+    """
+
+    def __init__(self, store: JobStore, concurrency: int = 4, heartbeat: float = 5.0):
+        self.store = store
+        self.concurrency = concurrency
+        self.heartbeat = heartbeat
+        self.running = False
+        self._tasks: list = []
+
+    async def _watch(self, job: Job, execution: asyncio.Task):
+        while not execution.done():
+            await asyncio.sleep(self.heartbeat)
+            if not await self.store.heartbeat(job):
+                job.cancelled = True
+                execution.cancel()
+
+    async def execute(self, job: Job):
+        handler = handlers.get(job.kind)
+        if job.cancelled:
+            job.status = "cancelled"
+            await self.store.finish(job)
+            return
+
+        async def report(progress: Any):
+            job.progress = progress
+
+        logger.info("Running job %s (%s)", job.id, job.kind)
+        execution = asyncio.create_task(handler(job.payload, report))  # type: ignore
+        watcher = asyncio.create_task(self._watch(job, execution))
+        try:
+            job.result = await execution
+            job.status = "done"
+        except asyncio.CancelledError:
+            if not job.cancelled:
+                raise  # the worker itself is stopping, the lease hands the job out again
+            job.status = "cancelled"
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Job %s failed: %s", job.id, exc)
+            job.status = "failed"
+            job.error = str(exc) or exc.__class__.__name__
+        finally:
+            watcher.cancel()
+            execution.cancel()
+        await self.store.finish(job)
+        logger.info("Job %s %s", job.id, job.status)
+
+    async def _loop(self):
+        while self.running:
+            try:
+                job = await self.store.claim(timeout=self.heartbeat)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Could not claim a job: %s", exc)
+                await asyncio.sleep(self.heartbeat)
+                continue
+            if job is None:
+                continue
+            if job.kind not in handlers:
+                job.status, job.error = "failed", f"Unknown job kind {job.kind}"
+                await self.store.finish(job)
+                continue
+            await self.execute(job)
+
+    async def start(self):
+        self.running = True
+        self._tasks = [asyncio.create_task(self._loop()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        self.running = False
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def run(self):
+        await self.start()
+        try:
+            await asyncio.gather(*self._tasks)
+        finally:
+            await self.stop()
+
+
+def get_store() -> JobStore:
+    default = "redis" if "REDIS_URL" in os.environ else "sqlite"
+    if os.environ.get("JOBS_BACKEND", default) == "redis":
+        return RedisJobStore(os.environ.get("REDIS_URL", "redis://localhost:6379/0"))
+    return SQLiteJobStore(os.environ.get("JOBS_PATH", "/tmp/hhmc-jobs/jobs.db"))
+
+
+jobs = get_store()
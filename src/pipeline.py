@@ -0,0 +1,62 @@
+import asyncio
+from typing import Any, Awaitable, Callable, List
+
+# The stages pass items that have `skipped()`, true once there is nothing left to do for
+# them, and `fail(exc)`, which records their error. `None` ends the stream.
+
+
+async def stage(
+    inbox: asyncio.Queue,
+    outbox: asyncio.Queue,
+    func: Callable[[Any], Awaitable[None]],
+    workers: int,
+):
+    """Runs `func` over every item of `inbox` with `workers` workers and hands each one on"""
+
+    async def worker():
+        while (item := await inbox.get()) is not None:
+            if not item.skipped():
+                try:
+                    await func(item)
+                except Exception as exc:  # pylint: disable=broad-except
+                    item.fail(exc)
+            await outbox.put(item)
+        await inbox.put(None)  # lets the sibling workers see the end too
+
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    await outbox.put(None)
+
+
+async def batched(
+    inbox: asyncio.Queue,
+    outbox: asyncio.Queue,
+    func: Callable[[List[Any]], Awaitable[None]],
+    size: int,
+    interval: float,
+):
+    """
+    Runs `func` over batches of up to `size` items of `inbox` and hands them on, a partial
+    batch goes once no item arrived for `interval` seconds
+    """
+    finished = False
+    while not finished:
+        batch: List[Any] = []
+        while len(batch) < size:
+            try:
+                item = await asyncio.wait_for(inbox.get(), timeout=interval)
+            except asyncio.TimeoutError:
+                if batch:
+                    break
+                continue
+            if item is None:
+                finished = True
+                break
+            if item.skipped():
+                await outbox.put(item)
+                continue
+            batch.append(item)
+        if batch:
+            await func(batch)
+            for item in batch:
+                await outbox.put(item)
+    await outbox.put(None)
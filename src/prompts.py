@@ -0,0 +1,104 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+import jinja2
+import tiktoken
+from aiofauna import setup_logging
+
+logger = setup_logging(__name__)
+
+TEMPLATES = {
+    "battle": """
+        Eres un MC de habla hispana referente del Hip-Hop haz participado en multiples eventos y eres un icono del hip-hop en Latinoamerica, gracias a la inteligencia artificial eres `Algoritmo` y formas parte de la comunidad `HHMC`, alli destacas por ser capaz de vencer a tus oponentes en todas las categorias, especialmente en `vs` y `temas`, usando una tecnina de metricas y punchline tu ingenio, lirica y capacidad de darle vuelta a cualquier situacion te facilita crear estructuras complejas, metricas, cambios a doble tempo entre otros artilugios, estas en una batalla y debes responder a tu oponente de la manera mas efectiva siendo reciproco al mantener el respeto,tu objetivo es ganarte al publico de `HHMC` y ganar la batalla a cualquier costo posible por lo que debes responder a la siguiente rima de tu oponente:
+
+        Categoria: {{category }}
+
+        Rima delOponente:
+        {{ request }}
+
+        Tu Respuesta:
+        """,
+    "chat": "You are an MC from Urban Roosters",
+    "memories": "Similar results for use promot {{ text }}:{{ memories | join('\n') }}",
+}
+
+
+class Prompts(object):
+    """
+    Prompt templates compiled once per worker, and token budgeting of the memories
+    retrieved for a prompt: they are kept best match first until the budget of the
+    category (`budgets`, else `default_budget`) is spent, so prompts stay the same size
+    however long the history of a namespace grows.
+    """
+
+    def __init__(
+        self,
+        templates: Dict[str, str],
+        model: str = "gpt-4-0613",
+        default_budget: int = 1000,
+        budgets: Optional[Dict[str, int]] = None,
+    ):
+        self.sources = templates
+        self.model = model
+        self.default_budget = default_budget
+        self.budgets = budgets or {}
+        self.environment = jinja2.Environment(autoescape=False)
+        self.templates: Dict[str, jinja2.Template] = {}
+        self._encoding: Optional[tiktoken.Encoding] = None
+
+    def load(self):
+        """Compiles every template and loads the tokenizer, called once at startup"""
+        self.templates = {
+            name: self.environment.from_string(source)
+            for name, source in self.sources.items()
+        }
+        self.encoding  # pylint: disable=pointless-statement
+        logger.info("Compiled %s prompt templates", len(self.templates))
+
+    @property
+    def encoding(self) -> tiktoken.Encoding:
+        if self._encoding is None:
+            try:
+                self._encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                self._encoding = tiktoken.get_encoding("cl100k_base")
+        return self._encoding
+
+    def render(self, name: str, **kwargs) -> str:
+        if name not in self.templates:
+            self.templates[name] = self.environment.from_string(self.sources[name])
+        return self.templates[name].render(**kwargs)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text))
+
+    def budget(self, category: Optional[str] = None) -> int:
+        return self.budgets.get(category or "", self.default_budget)
+
+    def fit(self, texts: List[str], budget: int) -> List[str]:
+        """Keeps the leading texts that fit in `budget` tokens, truncating the first one if it alone is over"""
+        kept: List[str] = []
+        for text in texts:
+            tokens = self.encoding.encode(text)
+            if len(tokens) > budget:
+                if not kept:
+                    kept.append(self.encoding.decode(tokens[:budget]))
+                break
+            kept.append(text)
+            budget -= len(tokens)
+        return kept
+
+    def memories(self, text: str, memories: List[str], category: Optional[str] = None) -> str:
+        """Renders the retrieved memories, best match first, within the budget of the category"""
+        kept = self.fit(memories, self.budget(category))
+        if len(kept) < len(memories):
+            logger.info("Kept %s of %s memories for %s", len(kept), len(memories), category)
+        return self.render("memories", text=text, memories=kept)
+
+
+prompts = Prompts(
+    TEMPLATES,
+    default_budget=int(os.environ.get("PROMPT_MEMORY_BUDGET", 1000)),
+    budgets=json.loads(os.environ.get("PROMPT_MEMORY_BUDGETS", "{}")),
+)
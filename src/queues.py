@@ -0,0 +1,282 @@
+import asyncio
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import openai
+from aiofauna import setup_logging
+from cheapcone import Embedding
+
+from .clients import pinecone, use_openai_pool
+
+logger = setup_logging(__name__)
+
+Pending = Tuple[Embedding, "asyncio.Future[None]"]
+
+
+class UpsertQueue(object):
+    """
+    Write-behind buffer that coalesces Pinecone upserts from concurrent requests into
+    batches of up to `batch_size` embeddings and `max_bytes` of JSON (Pinecone refuses
+    upserts over 2MB), sent when a batch fills up or `interval` seconds after the first
+    pending write. Failed batches are retried with exponential backoff, and at
+    most `max_pending` embeddings are held in memory, beyond that `put` waits for room.
+    """
+
+    def __init__(
+        self,
+        batch_size: int = 100,
+        max_bytes: int = 1_500_000,
+        interval: float = 1.0,
+        max_pending: int = 10000,
+        retries: int = 5,
+    ):
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.retries = retries
+        self.pending: List[Pending] = []
+        self.inflight: List[Pending] = []
+        self._room = asyncio.Semaphore(max_pending)
+        self._ready: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._ready = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, embeddings: List[Embedding]) -> "asyncio.Future[int]":
+        """
+        Queues the embeddings and returns a future that resolves to their count once
+        Pinecone has acknowledged all of them, callers that need read-your-writes await it
+        """
+        self._start()
+        loop = asyncio.get_running_loop()
+        futures = []
+        for embedding in embeddings:
+            await self._room.acquire()
+            future = loop.create_future()
+            self.pending.append((embedding, future))
+            futures.append(future)
+        if len(self.pending) >= self.batch_size:
+            self._ready.set()  # type: ignore
+        counted = asyncio.ensure_future(self._count(asyncio.gather(*futures)))
+        counted.add_done_callback(lambda task: task.cancelled() or task.exception())
+        return counted
+
+    @staticmethod
+    async def _count(done: "asyncio.Future[list]") -> int:
+        return len(await done)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout=self.interval)  # type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()  # type: ignore
+            while self.pending:
+                await self._send(self._take())
+
+    @staticmethod
+    def _size(embedding: Embedding) -> int:
+        return len(json.dumps(embedding.values)) + len(
+            json.dumps(embedding.metadata, default=str)
+        )
+
+    def _take(self) -> List[Pending]:
+        """The next batch, as many pending embeddings as fit in `batch_size` and `max_bytes`, at least one"""
+        count = size = 0
+        for embedding, _ in self.pending[: self.batch_size]:
+            size += self._size(embedding) + 64  # the id and the keys around them
+            if count and size > self.max_bytes:
+                break
+            count += 1
+        batch = self.pending[:count]
+        del self.pending[:count]
+        return batch
+
+    async def _send(self, batch: List[Pending]):
+        self.inflight.extend(batch)
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    await pinecone.upsert([embedding for embedding, _ in batch])
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+                    return
+                except Exception as exc:  # pylint: disable=broad-except
+                    if attempt == self.retries:
+                        logger.error("Dropping batch of %s embeddings: %s", len(batch), exc)
+                        for _, future in batch:
+                            if not future.done():
+                                future.set_exception(exc)
+                        return
+                    delay = min(2**attempt * 0.5, 30)
+                    logger.warning("Upsert failed (%s), retrying in %ss", exc, delay)
+                    await asyncio.sleep(delay)
+        finally:
+            for item in batch:
+                self.inflight.remove(item)
+                self._room.release()
+
+    async def delete(self, filter: Dict[str, Any]):
+        """
+        Deletes the vectors whose metadata matches `filter` right away, ahead of whatever is
+        still queued, so replacements put after this call survive it
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                await pinecone.post("/vectors/delete", {"filter": filter})
+                return
+            except Exception as exc:  # pylint: disable=broad-except
+                if attempt == self.retries:
+                    raise
+                delay = min(2**attempt * 0.5, 30)
+                logger.warning("Delete failed (%s), retrying in %ss", exc, delay)
+                await asyncio.sleep(delay)
+
+    async def flush(self):
+        """Sends everything queued so far and waits until Pinecone has acknowledged it"""
+        futures = [future for _, future in self.pending + self.inflight]
+        if not futures:
+            return
+        self._start()
+        self._ready.set()  # type: ignore
+        await asyncio.gather(*futures, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class MemoryQueue(object):
+    """
+    Write-behind buffer for the conversational memory: the turns of every connection are
+    grouped per namespace and ingested in batches, embedded with a single OpenAI call and
+    handed to the upsert queue. A namespace is flushed once it holds `batch_size` texts,
+    `interval` seconds after its first pending text, or when `flush_nowait` is called.
+    """
+
+    def __init__(
+        self,
+        upserts: UpsertQueue,
+        batch_size: int = 32,
+        interval: float = 2.0,
+        max_pending: int = 5000,
+        retries: int = 3,
+        model: str = "text-embedding-ada-002",
+    ):
+        self.upserts = upserts
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retries = retries
+        self.model = model
+        self.pending: Dict[str, List[str]] = {}
+        self.since: Dict[str, float] = {}
+        self.due: set = set()
+        self.inflight: List[asyncio.Future] = []
+        self._room = asyncio.Semaphore(max_pending)
+        self._ready: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _start(self):
+        if self._task is None or self._task.done():
+            self._ready = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, namespace: str, texts: List[str]):
+        """Queues the texts for ingestion, only waits when `max_pending` texts are already queued"""
+        self._start()
+        for _ in texts:
+            await self._room.acquire()
+        self.pending.setdefault(namespace, []).extend(texts)
+        self.since.setdefault(namespace, time.monotonic())
+        if len(self.pending[namespace]) >= self.batch_size:
+            self.flush_nowait(namespace)
+
+    def flush_nowait(self, namespace: str):
+        """Sends whatever the namespace holds on the next tick, without waiting for it"""
+        if namespace in self.pending and self._ready is not None:
+            self.due.add(namespace)
+            self._ready.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout=self.interval / 2)  # type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self._ready.clear()  # type: ignore
+            now = time.monotonic()
+            for namespace in list(self.pending):
+                if namespace in self.due or now - self.since[namespace] >= self.interval:
+                    self._send_later(namespace)
+
+    def _send_later(self, namespace: str) -> asyncio.Future:
+        texts = self.pending.pop(namespace)
+        del self.since[namespace]
+        self.due.discard(namespace)
+        future = asyncio.ensure_future(self._send(namespace, texts))
+        self.inflight.append(future)
+        future.add_done_callback(self.inflight.remove)
+        return future
+
+    async def _send(self, namespace: str, texts: List[str]):
+        use_openai_pool()
+        try:
+            for start in range(0, len(texts), self.batch_size):
+                batch = texts[start : start + self.batch_size]
+                for attempt in range(self.retries + 1):
+                    try:
+                        response = await openai.Embedding.acreate(model=self.model, input=batch)
+                        break
+                    except Exception as exc:  # pylint: disable=broad-except
+                        if attempt == self.retries:
+                            logger.error("Dropping %s turns of %s: %s", len(batch), namespace, exc)
+                            return
+                        await asyncio.sleep(min(2**attempt * 0.5, 30))
+                embeddings = [
+                    Embedding(
+                        values=item["embedding"],  # type: ignore
+                        metadata={"text": text, "namespace": namespace},
+                    )
+                    for text, item in zip(batch, response["data"])  # type: ignore
+                ]
+                await (await self.upserts.put(embeddings))
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Could not ingest %s turns of %s: %s", len(texts), namespace, exc)
+        finally:
+            for _ in texts:
+                self._room.release()
+
+    async def flush(self, namespace: Optional[str] = None):
+        """Ingests everything queued so far, for one namespace or all of them, and waits for it"""
+        namespaces = [namespace] if namespace is not None else list(self.pending)
+        for name in namespaces:
+            if name in self.pending:
+                self._send_later(name)
+        await asyncio.gather(*self.inflight, return_exceptions=True)
+
+    async def close(self):
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+upserts = UpsertQueue(
+    batch_size=int(os.environ.get("UPSERT_BATCH_SIZE", 100)),
+    max_bytes=int(os.environ.get("UPSERT_MAX_BYTES", 1_500_000)),
+    interval=float(os.environ.get("UPSERT_INTERVAL", 1.0)),
+)
+memory = MemoryQueue(
+    upserts,
+    batch_size=int(os.environ.get("MEMORY_BATCH_SIZE", 32)),
+    interval=float(os.environ.get("MEMORY_INTERVAL", 2.0)),
+)
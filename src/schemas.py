@@ -1,6 +1,7 @@
-from typing import Optional
+from typing import List, Optional
 
 from aiofauna import FaunaModel, Field
+from aiofauna.faunadb import query as q
 from pydantic import HttpUrl  # pylint: disable=no-name-in-module
 from pydantic import BaseModel
 
@@ -36,6 +37,37 @@ class AudioTrack(FaunaModel):
     lyrics: Optional[str] = Field(default=None)
     namespace: str = Field(default="audio_tracks")
 
+    @classmethod
+    async def save_many(cls, tracks: List["AudioTrack"]) -> List["AudioTrack"]:
+        """
+        Saves the given tracks in a single query, returning the stored document instead
+        of creating a new one when a track with the same url already exists
+        """
+        match = q.match(q.index("audiotrack_url_unique"), q.select("url", q.var("data")))
+        data = await cls.q()(
+            q.map_(
+                q.lambda_(
+                    "data",
+                    q.if_(
+                        q.exists(match),
+                        q.get(match),
+                        q.create(q.collection("audiotrack"), {"data": q.var("data")}),
+                    ),
+                ),
+                [track.dict() for track in tracks],
+            )
+        )
+        return [
+            cls(
+                **{
+                    **item["data"],  # type: ignore
+                    "ref": item["ref"]["@ref"]["id"],  # type: ignore
+                    "ts": item["ts"] / 1000,  # type: ignore
+                }
+            )
+            for item in data  # type: ignore
+        ]
+
 
 class Namespace(FaunaModel):
     """
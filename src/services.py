@@ -1,6 +1,8 @@
+import asyncio
 import io
 import json
 import re
+from collections import OrderedDict
 from concurrent.futures import ProcessPoolExecutor
 from dataclasses import dataclass, field
 from os import environ
@@ -8,29 +10,39 @@ from os import environ
 from aiofauna import *
 from aiofauna.helpers import ThreadPoolExecutor
 from aiofauna.llm import LLMStack
-from aiohttp import ClientSession
 from aiohttp.web_exceptions import HTTPException
 from boto3 import Session
-from cheapcone import Embedding, QueryBuilder
+from cheapcone import Embedding, QueryBuilder, Vector
 from pytube import YouTube
 from typing_extensions import override
 
+from .cache import cache, ingested
+from .clients import http
+from .index import audio_knn, index
+from .queues import upserts
 from .schemas import AudioTrack, Namespace, User, YouTubeVideo
-from .utils import mp3_to_vect, sound_to_vect
+from .utils import (SAMPLE_RATE, EmbeddingMode, StreamDecoder, embedding_version,
+                    engine)
 
 logger = setup_logging(__name__)
 llm = LLMStack()
 
+AUDIO_WINDOW = int(environ.get("YOUTUBE_AUDIO_WINDOW", 0))
+
 
 class YoutubeClient(object):
     executor = ThreadPoolExecutor(max_workers=10)
+    status: "OrderedDict[str, str]" = OrderedDict()
+    max_status = 10000
+    scheduled: "OrderedDict[str, List[str]]" = OrderedDict()
+    max_scheduled = 1000
+    tasks: Set[asyncio.Task] = set()
 
     async def search(self, id: str):
-        async with ClientSession() as session:
-            async with session.get(f"https://www.youtube.com/watch?v={id}") as response:
-                data = await response.text()
-                related_videos = re.findall(r"watch\?v=(.{11})", data)
-                return list(set(related_videos))
+        async with http.session().get(f"https://www.youtube.com/watch?v={id}") as response:
+            data = await response.text()
+            related_videos = re.findall(r"watch\?v=(.{11})", data)
+            return list(set(related_videos))
 
     @asyncify
     def download(self, id: str):
@@ -44,32 +56,152 @@ class YoutubeClient(object):
         buffer.seek(0)
         return buffer.read()
 
-    async def upsert(self, id: str):
-        """Upserts the given track url to Pinecone"""
-        raw_audio = await self.download(id)
-        normalized_embedding = sound_to_vect(raw_audio)
-        return await llm.pinecone.upsert(
-            [
-                Embedding(
-                    values=normalized_embedding,
-                    metadata={
-                        "id": id,
-                        "url": f"https://www.youtube.com/watch?v={id}",
-                        "namespace": "audio_tracks",
-                    },
-                )
-            ]
-        )  # type: ignore
+    @asyncify
+    def audio_stream(self, id: str) -> Tuple[str, int]:
+        """Returns the url and bitrate (bits per second) of the audio stream of the given video"""
+        yt = YouTube(f"https://www.youtube.com/watch?v={id}")
+        stream = yt.streams.filter(only_audio=True).first()
+        assert stream is not None
+        return stream.url, stream.bitrate or 160000
+
+    async def download_window(self, id: str, seconds: int) -> bytes:
+        """
+        Fetches only the first `seconds` of the audio stream with a byte-range request and
+        decodes it as it arrives, returning mono 16-bit PCM of at most `seconds`
+        """
+        url, bitrate = await self.audio_stream(id)
+        limit = bitrate * seconds // 8 + 2**16  # plus room for the container header
+        decoder = await StreamDecoder().start()
+        received = 0
+        try:
+            headers = {"Range": f"bytes=0-{limit - 1}"}
+            async with http.session("media").get(url, headers=headers) as response:
+                async for chunk in response.content.iter_chunked(2**16):
+                    chunk = chunk[: limit - received]
+                    received += len(chunk)
+                    await decoder.feed(chunk)
+                    if received >= limit:
+                        break
+            logger.info(f"Fetched {received} bytes of {id}")
+            pcm = await decoder.finish()
+        except BaseException:
+            decoder.kill()
+            raise
+        return pcm[: seconds * decoder.sample_rate * 2]
+
+    async def embed(
+        self, id: str, mode: EmbeddingMode = "fft", window: int = AUDIO_WINDOW
+    ) -> Vector:
+        """Embeds the audio of the given video, skipping the download on a cache hit. A non-zero `window` embeds only the first `window` seconds, fetched with a range request."""
+        if window:
+            key = cache.alias_key(f"youtube:{id}:{window}s", mode)
+
+            async def embed_window():
+                pcm = await self.download_window(id, window)
+                return await engine.pcm_to_vect(pcm, mode), len(pcm) / 2 / SAMPLE_RATE
+
+            return (await cache.fetch([key], embed_window))[0]
+        video_key = cache.alias_key(f"youtube:{id}", mode)
+        cached = await cache.get(video_key)
+        if cached is None:
+            raw_audio = await self.download(id)
+
+            async def embed():
+                return await engine.sound_to_vect(raw_audio, mode), 0.0
+
+            cached = await cache.fetch(
+                [cache.content_key(raw_audio, mode), video_key], embed
+            )
+        return cached[0]
+
+    async def upsert(self, id: str, mode: EmbeddingMode = "fft") -> Optional[int]:
+        """Upserts the given track url to Pinecone unless it was already ingested with the current embedding version, returns None when skipped"""
+        version = embedding_version(mode, AUDIO_WINDOW)
+        if await ingested.seen(id, version):
+            logger.info(f"{id} already ingested with {version}")
+            return None
+        normalized_embedding = await self.embed(id, mode)
+        embeddings = [
+            Embedding(
+                values=normalized_embedding,
+                metadata={
+                    "id": id,
+                    "url": f"https://www.youtube.com/watch?v={id}",
+                    "namespace": "audio_tracks",
+                },
+            )
+        ]
+        durable = await upserts.put(embeddings)
+        await index.upsert(embeddings)
+        count = await durable
+        await ingested.mark(id, version)
+        return count
 
     async def query(self, id: str):
         """Returns the 10 KNN for t he given track url"""
-        namespace = q("namespace") == "audio_tracks"
-        normalized_embedding, _ = mp3_to_vect(await self.download(id))
-        results = await llm.pinecone.query(
-            expr=namespace.query, vector=normalized_embedding, topK=10
-        )
-        matches = results.matches
-        return sorted(matches, key=lambda x: x.score, reverse=True)
+        normalized_embedding = await self.embed(id)
+        return await audio_knn(normalized_embedding, topK=10)
+
+    async def details_many(
+        self, ids: List[str], concurrency: int = 5
+    ) -> AsyncIterator[YouTubeVideo]:
+        """Yields the details of the given videos as they arrive, at most `concurrency` at a time"""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def fetch(id: str):
+            async with semaphore:
+                return await self.details(id)
+
+        for future in asyncio.as_completed([fetch(id) for id in ids]):
+            try:
+                yield await future
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Could not fetch details: %s", exc)
+
+    def set_status(self, id: str, status: str):
+        self.status[id] = status
+        self.status.move_to_end(id)
+        while len(self.status) > self.max_status:
+            self.status.popitem(last=False)
+
+    def record(self, source: str, ids: List[str]):
+        """Remembers which videos were scheduled for the related videos of `source`"""
+        scheduled = self.scheduled.setdefault(source, [])
+        scheduled.extend(id for id in ids if id not in scheduled)
+        self.scheduled.move_to_end(source)
+        while len(self.scheduled) > self.max_scheduled:
+            self.scheduled.popitem(last=False)
+
+    def schedule_upserts(
+        self,
+        videos: List[YouTubeVideo],
+        semaphore: Optional[asyncio.Semaphore] = None,
+        max_duration: int = 300,
+        source: Optional[str] = None,
+    ):
+        """Upserts the given videos in the background, tracking each one in `status` and, given the video they are related to, in `scheduled`. Calls sharing `semaphore` share its concurrency cap, two by default."""
+        semaphore = semaphore or asyncio.Semaphore(2)
+        if source is not None:
+            self.record(source, [video.id for video in videos])
+
+        async def upsert(video: YouTubeVideo):
+            async with semaphore:
+                self.set_status(video.id, "running")
+                try:
+                    count = await self.upsert(video.id)
+                    self.set_status(video.id, "done" if count is not None else "ingested")
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error("Could not upsert %s: %s", video.id, exc)
+                    self.set_status(video.id, f"error: {exc}")
+
+        for video in videos:
+            if video.duration > max_duration:
+                self.set_status(video.id, "skipped")
+                continue
+            self.set_status(video.id, "queued")
+            task = asyncio.create_task(upsert(video))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
 
     @asyncify
     def details(self, id: str):
@@ -0,0 +1,136 @@
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from aiofauna import setup_logging
+
+logger = setup_logging(__name__)
+
+Turn = Tuple[str, str]
+
+
+@dataclass
+class Session:
+    """Recent turns of a single websocket, oldest first"""
+
+    namespace: str
+    id: str = field(default_factory=lambda: str(uuid4()))
+    turns: Deque[Turn] = field(default_factory=deque)
+    size: int = 0
+    dropped: int = 0
+    background: Optional[str] = None
+    used: float = field(default_factory=time.monotonic)
+
+    def needs_retrieval(self) -> bool:
+        """
+        Long-term memory is only searched for the first message, which brings in what earlier
+        sessions left in the namespace, and again once turns of this session fell out of the
+        window, since those only survive in the vector store
+        """
+        return self.background is None or self.dropped > 0
+
+    def messages(self) -> List[Dict[str, str]]:
+        messages = []
+        for request, response in self.turns:
+            messages.append({"role": "user", "content": request})
+            messages.append({"role": "assistant", "content": response})
+        return messages
+
+
+class Sessions(object):
+    """
+    Per worker registry of chat sessions. Every session keeps its last `max_turns` turns,
+    sessions idle for `idle_timeout` seconds are dropped, and when all of them together hold
+    more than `max_bytes` of text the oldest turns (then the retrieved memories) of the least
+    recently used sessions go first.
+    """
+
+    def __init__(
+        self,
+        max_turns: int = 6,
+        idle_timeout: float = 900,
+        max_bytes: int = 64 * 2**20,
+        sweep_interval: float = 60,
+    ):
+        self.max_turns = max_turns
+        self.idle_timeout = idle_timeout
+        self.max_bytes = max_bytes
+        self.sweep_interval = sweep_interval
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self.size = 0
+        self.evicted = 0
+        self._swept = time.monotonic()
+
+    def open(self, namespace: str) -> Session:
+        self._sweep()
+        session = Session(namespace=namespace)
+        self.sessions[session.id] = session
+        return session
+
+    def close(self, session: Session):
+        if self.sessions.pop(session.id, None) is not None:
+            self.size -= session.size + len(session.background or "")
+
+    def _drop_turn(self, session: Session):
+        request, response = session.turns.popleft()
+        session.size -= len(request) + len(response)
+        session.dropped += 1
+        self.size -= len(request) + len(response)
+
+    def record(
+        self, session: Session, request: str, response: str, background: Optional[str] = None
+    ):
+        """Appends a turn, and the memories retrieved for it, evicting turns to stay within the limits"""
+        if session.id not in self.sessions:
+            # it was evicted while idle, the socket is back so it counts again
+            self.sessions[session.id] = session
+            self.size += session.size + len(session.background or "")
+        if background is not None:
+            self.size += len(background) - len(session.background or "")
+            session.background = background
+        session.turns.append((request, response))
+        session.size += len(request) + len(response)
+        self.size += len(request) + len(response)
+        while len(session.turns) > self.max_turns:
+            self._drop_turn(session)
+        session.used = time.monotonic()
+        self.sessions.move_to_end(session.id)
+        for victim in list(self.sessions.values()):
+            if self.size <= self.max_bytes:
+                break
+            while victim.turns and self.size > self.max_bytes:
+                self._drop_turn(victim)
+                self.evicted += 1
+            if self.size > self.max_bytes and victim.background is not None:
+                self.size -= len(victim.background)
+                victim.background = None
+        self._sweep()
+
+    def _sweep(self):
+        now = time.monotonic()
+        if now - self._swept < self.sweep_interval:
+            return
+        self._swept = now
+        idle = [s for s in self.sessions.values() if now - s.used > self.idle_timeout]
+        for session in idle:
+            self.close(session)
+        if idle:
+            logger.info("Evicted %s idle chat sessions", len(idle))
+
+    def stats(self):
+        return {
+            "sessions": len(self.sessions),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "evicted_turns": self.evicted,
+        }
+
+
+sessions = Sessions(
+    max_turns=int(os.environ.get("SESSION_TURNS", 6)),
+    idle_timeout=float(os.environ.get("SESSION_IDLE_TIMEOUT", 900)),
+    max_bytes=int(os.environ.get("SESSION_MAX_BYTES", 64 * 2**20)),
+)
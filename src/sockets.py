@@ -0,0 +1,105 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, Optional, Set
+
+from aiofauna import Request, WebSocketResponse, setup_logging
+from aiohttp import WSCloseCode, WSMsgType
+
+logger = setup_logging(__name__)
+
+OnMessage = Callable[[WebSocketResponse, str], Awaitable[None]]
+
+
+class ConnectionManager(object):
+    """
+    Serves the chat websockets: aiohttp pings every socket each `heartbeat` seconds and
+    closes it when the pong does not come back, every socket handles one message at a time
+    with at most `queue_size` more waiting (beyond that the client gets a `busy` error
+    frame), and at most `max_llm_calls` messages are answered at once across all sockets.
+    """
+
+    def __init__(self, heartbeat: float = 30, queue_size: int = 4, max_llm_calls: int = 32):
+        self.heartbeat = heartbeat
+        self.queue_size = queue_size
+        self.max_llm_calls = max_llm_calls
+        self.sockets: Set[WebSocketResponse] = set()
+        self.queued = 0
+        self.inflight = 0
+        self.rejected = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    @property
+    def slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_llm_calls)
+        return self._slots
+
+    async def _work(self, websocket: WebSocketResponse, inbox: asyncio.Queue, on_message: OnMessage):
+        while True:
+            text = await inbox.get()
+            self.queued -= 1
+            async with self.slots:
+                self.inflight += 1
+                try:
+                    await on_message(websocket, text)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error("Could not answer message: %s", exc)
+                    if not websocket.closed:
+                        await websocket.send_json({"type": "error", "error": str(exc)})
+                finally:
+                    self.inflight -= 1
+
+    async def serve(self, request: Request, on_message: OnMessage) -> WebSocketResponse:
+        """Accepts the websocket and feeds its text messages, one by one, to `on_message`"""
+        websocket = WebSocketResponse(heartbeat=self.heartbeat)
+        await websocket.prepare(request)
+        inbox: asyncio.Queue = asyncio.Queue(self.queue_size)
+        worker = asyncio.create_task(self._work(websocket, inbox, on_message))
+        self.sockets.add(websocket)
+        try:
+            async for message in websocket:
+                if message.type != WSMsgType.TEXT:
+                    continue
+                if inbox.full():
+                    self.rejected += 1
+                    await websocket.send_json(
+                        {"type": "error", "error": "busy", "queue_size": self.queue_size}
+                    )
+                    continue
+                inbox.put_nowait(message.data)
+                self.queued += 1
+        finally:
+            # The socket is gone, drop what it queued and stop its in-flight reply
+            self.queued -= inbox.qsize()
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+            self.sockets.discard(websocket)
+            if not websocket.closed:
+                await websocket.close()
+        return websocket
+
+    async def close(self):
+        """Closes every open socket, called on shutdown"""
+        await asyncio.gather(
+            *[
+                websocket.close(code=WSCloseCode.GOING_AWAY, message=b"Server shutdown")
+                for websocket in list(self.sockets)
+            ],
+            return_exceptions=True,
+        )
+
+    def stats(self):
+        return {
+            "active": len(self.sockets),
+            "queued": self.queued,
+            "inflight": self.inflight,
+            "rejected": self.rejected,
+            "max_llm_calls": self.max_llm_calls,
+        }
+
+
+sockets = ConnectionManager(
+    heartbeat=float(os.environ.get("WEBSOCKET_HEARTBEAT", 30)),
+    queue_size=int(os.environ.get("WEBSOCKET_QUEUE_SIZE", 4)),
+    max_llm_calls=int(os.environ.get("MAX_LLM_CALLS", 32)),
+)
@@ -0,0 +1,315 @@
+import asyncio
+import os
+import re
+from abc import ABC, abstractmethod
+from datetime import datetime, timedelta, timezone
+from typing import AsyncIterator, Dict, List, Optional
+from urllib.parse import quote
+
+from aiofauna import setup_logging
+from aiohttp import ClientSession
+from boto3 import Session
+from botocore.auth import S3SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.credentials import ReadOnlyCredentials
+from yarl import URL
+
+from .clients import http
+
+logger = setup_logging(__name__)
+
+BUCKET = "audio-aiofauna"
+PART_SIZE = 8 * 2**20  # S3 needs at least 5MB for every part but the last
+CHUNK_SIZE = 2**16
+
+
+class ObjectWriter(ABC):
+    """Incremental upload of a single object, the object only becomes visible on `complete`"""
+
+    @abstractmethod
+    async def write(self, chunk: bytes):
+        ...
+
+    @abstractmethod
+    async def complete(self) -> str:
+        ...
+
+    @abstractmethod
+    async def abort(self):
+        ...
+
+
+class ObjectStorage(ABC):
+    """Minimal object storage interface used by the handlers"""
+
+    @abstractmethod
+    def url(self, key: str) -> str:
+        ...
+
+    @abstractmethod
+    def writer(self, key: str) -> ObjectWriter:
+        ...
+
+    @abstractmethod
+    def stream(self, key: str) -> AsyncIterator[bytes]:
+        ...
+
+    async def put(self, key: str, body: bytes) -> str:
+        """Uploads the given body, in parallel parts when it is large, and returns its url"""
+        writer = self.writer(key)
+        try:
+            await writer.write(body)
+            return await writer.complete()
+        except BaseException:
+            await writer.abort()
+            raise
+
+    async def get(self, key: str) -> bytes:
+        return b"".join([chunk async for chunk in self.stream(key)])
+
+
+class S3Writer(ObjectWriter):
+    """
+    Streams an object to S3 as it is produced: chunks are buffered into parts and every
+    full part is uploaded in the background while the caller keeps writing.
+    """
+
+    def __init__(self, storage: "S3Storage", key: str):
+        self.storage = storage
+        self.key = key
+        self.buffer = bytearray()
+        self.upload_id: Optional[str] = None
+        self.parts: List[asyncio.Future] = []
+
+    async def _upload_part(self, number: int, body: bytes) -> str:
+        params = {"partNumber": str(number), "uploadId": self.upload_id}
+        headers = await self.storage.request("PUT", self.key, params, body)
+        return headers["ETag"]
+
+    async def write(self, chunk: bytes):
+        self.buffer.extend(chunk)
+        part_size = self.storage.part_size
+        while len(self.buffer) >= part_size:
+            if self.upload_id is None:
+                body = await self.storage.request(
+                    "POST", self.key, {"uploads": ""}, read=True
+                )
+                match = re.search(r"<UploadId>(.+?)</UploadId>", body.decode())
+                self.upload_id = match.group(1)  # type: ignore
+            inflight = [part for part in self.parts if not part.done()]
+            if len(inflight) >= self.storage.max_inflight:
+                await asyncio.wait(inflight, return_when=asyncio.FIRST_COMPLETED)
+            body = bytes(self.buffer[:part_size])
+            del self.buffer[:part_size]
+            self.parts.append(
+                asyncio.ensure_future(self._upload_part(len(self.parts) + 1, body))
+            )
+
+    async def complete(self) -> str:
+        """Uploads the remainder, waits for every part and returns the object url"""
+        if self.upload_id is None:
+            await self.storage.request("PUT", self.key, {}, bytes(self.buffer))
+            return self.storage.url(self.key)
+        if self.buffer:
+            self.parts.append(
+                asyncio.ensure_future(
+                    self._upload_part(len(self.parts) + 1, bytes(self.buffer))
+                )
+            )
+        self.buffer.clear()
+        etags = await asyncio.gather(*self.parts)
+        manifest = "".join(
+            f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+            for number, etag in enumerate(etags, start=1)
+        )
+        await self.storage.request(
+            "POST",
+            self.key,
+            {"uploadId": self.upload_id},  # type: ignore
+            f"<CompleteMultipartUpload>{manifest}</CompleteMultipartUpload>".encode(),
+        )
+        return self.storage.url(self.key)
+
+    async def abort(self):
+        for part in self.parts:
+            part.cancel()
+        if self.upload_id is not None:
+            try:
+                params = {"uploadId": self.upload_id}
+                await self.storage.request("DELETE", self.key, params)
+            except Exception as exc:  # pylint: disable=broad-except
+                logger.error("Could not abort upload of %s: %s", self.key, exc)
+
+
+class S3Storage(ObjectStorage):
+    """
+    S3 over the shared `storage` HTTP pool, requests are signed with botocore's SigV4
+    signer so credentials resolve exactly as they did with the boto3 client. Resolving
+    them may call STS or the instance metadata service, so it happens in a thread, once,
+    and again shortly before temporary credentials expire.
+    """
+
+    def __init__(
+        self,
+        bucket: str = BUCKET,
+        part_size: int = PART_SIZE,
+        max_inflight: int = 4,
+    ):
+        self.bucket = bucket
+        self.part_size = part_size
+        self.max_inflight = max_inflight
+        self.aws = Session()
+        self.region = self.aws.region_name or "us-east-1"
+        self._credentials: Optional[ReadOnlyCredentials] = None
+        self._expiry: Optional[datetime] = None
+        self._resolving = asyncio.Lock()
+
+    @property
+    def session(self) -> ClientSession:
+        return http.session("storage")
+
+    def url(self, key: str) -> str:
+        return f"https://{self.bucket}.s3.amazonaws.com/{quote(key, safe='/~')}"
+
+    def _endpoint(self, key: str) -> str:
+        return f"https://{self.bucket}.s3.{self.region}.amazonaws.com/{key}"
+
+    def _resolve(self) -> ReadOnlyCredentials:
+        source = self.aws.get_credentials()
+        if source is None:
+            raise IOError("No AWS credentials found")
+        # botocore refreshes temporary credentials within 15 minutes of their expiry
+        self._expiry = getattr(source, "_expiry_time", None)
+        return source.get_frozen_credentials()
+
+    def _stale(self) -> bool:
+        if self._credentials is None:
+            return True
+        if self._expiry is None:
+            return False
+        return self._expiry - timedelta(minutes=15) <= datetime.now(timezone.utc)
+
+    async def credentials(self) -> ReadOnlyCredentials:
+        if self._stale():
+            async with self._resolving:
+                if self._stale():
+                    loop = asyncio.get_running_loop()
+                    self._credentials = await loop.run_in_executor(None, self._resolve)
+        return self._credentials  # type: ignore
+
+    def _sign(
+        self,
+        method: str,
+        key: str,
+        params: Dict[str, str],
+        body: bytes,
+        credentials: ReadOnlyCredentials,
+    ) -> Dict[str, str]:
+        # S3 signs the path exactly as sent, so it must already be percent-encoded
+        request = AWSRequest(
+            method=method,
+            url=self._endpoint(quote(key, safe="/~")),
+            params=params,
+            data=body,
+        )
+        S3SigV4Auth(credentials, "s3", self.region).add_auth(request)
+        return dict(request.headers.items())
+
+    def _url(self, key: str, params: Dict[str, str]) -> URL:
+        url = URL(self._endpoint(quote(key, safe="/~")), encoded=True)
+        return url.with_query(params) if params else url
+
+    async def request(
+        self,
+        method: str,
+        key: str,
+        params: Dict[str, str],
+        body: bytes = b"",
+        read: bool = False,
+    ):
+        headers = self._sign(method, key, params, body, await self.credentials())
+        async with self.session.request(
+            method, self._url(key, params), data=body or None, headers=headers
+        ) as response:
+            if response.status >= 300:
+                text = await response.text()
+                raise IOError(f"S3 {method} {key} failed with {response.status}: {text}")
+            return await response.read() if read else response.headers
+
+    def writer(self, key: str) -> S3Writer:
+        return S3Writer(self, key)
+
+    async def stream(self, key: str) -> AsyncIterator[bytes]:
+        headers = self._sign("GET", key, {}, b"", await self.credentials())
+        async with self.session.get(self._url(key, {}), headers=headers) as response:
+            if response.status >= 300:
+                raise IOError(f"S3 GET {key} failed with {response.status}")
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                yield chunk
+
+
+class LocalWriter(ObjectWriter):
+    def __init__(self, storage: "LocalStorage", key: str):
+        self.storage = storage
+        self.key = key
+        self.path = storage.path(key)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(f"{self.path}.part", "wb")
+
+    async def write(self, chunk: bytes):
+        self.file.write(chunk)
+
+    async def complete(self) -> str:
+        self.file.close()
+        os.replace(f"{self.path}.part", self.path)
+        return self.storage.url(self.key)
+
+    async def abort(self):
+        self.file.close()
+        if os.path.exists(f"{self.path}.part"):
+            os.remove(f"{self.path}.part")
+
+
+class LocalStorage(ObjectStorage):
+    """
+    Filesystem stand-in for S3, used for local runs and tests. Objects are served by the
+    app under `/storage`, `public_url` is where that route is reachable from clients.
+    """
+
+    def __init__(
+        self,
+        root: str = "/tmp/hhmc-storage",
+        public_url: str = "http://127.0.0.1:4200/storage",
+    ):
+        self.root = root
+        self.public_url = public_url.rstrip("/")
+
+    def path(self, key: str) -> str:
+        path = os.path.abspath(os.path.join(self.root, key))
+        if not path.startswith(os.path.abspath(self.root) + os.sep):
+            raise ValueError(f"Invalid key {key}")
+        return path
+
+    def url(self, key: str) -> str:
+        self.path(key)  # rejects keys outside the root
+        return f"{self.public_url}/{quote(key, safe='/~')}"
+
+    def writer(self, key: str) -> LocalWriter:
+        return LocalWriter(self, key)
+
+    async def stream(self, key: str) -> AsyncIterator[bytes]:
+        with open(self.path(key), "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+
+def get_storage() -> ObjectStorage:
+    if os.environ.get("STORAGE_BACKEND", "s3") == "local":
+        return LocalStorage(
+            os.environ.get("STORAGE_PATH", "/tmp/hhmc-storage"),
+            os.environ.get("STORAGE_PUBLIC_URL", "http://127.0.0.1:4200/storage"),
+        )
+    return S3Storage(bucket=os.environ.get("STORAGE_BUCKET", BUCKET))
+
+
+storage = get_storage()
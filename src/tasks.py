@@ -0,0 +1,55 @@
+from typing import Any, AsyncIterator, Dict
+
+from .ingest import BulkIngestion, BulkItem
+from .jobs import Report, task
+from .services import YoutubeClient
+from .website import sitemap_pipeline
+
+yt = YoutubeClient()
+
+
+@task("youtube.upsert")
+async def youtube_upsert(payload: Dict[str, Any], report: Report):
+    """Embeds and upserts a YouTube video, `payload` holds its `id` and optional `mode`"""
+    count = await yt.upsert(payload["id"], payload.get("mode", "fft"))
+    return {"id": payload["id"], "count": count, "skipped": count is None}
+
+
+@task("tracks.bulk")
+async def tracks_bulk(payload: Dict[str, Any], report: Report):
+    """Ingests the stored tracks of `payload["keys"]` for a `user` and `playlist`"""
+    ingestion = BulkIngestion(
+        user=payload["user"],
+        playlist=payload["playlist"],
+        mode=payload.get("mode", "fft"),
+    )
+
+    async def items() -> AsyncIterator[BulkItem]:
+        for key in payload["keys"]:
+            yield ingestion.item(key)
+
+    errors = []
+    summary: Dict[str, Any] = {}
+    async for result in ingestion.run(items()):
+        if "progress" not in result:
+            summary = result
+            continue
+        if result["status"] == "error":
+            errors.append({"name": result["name"], "error": result["error"]})
+        await report(result["progress"])
+    return {**summary, "errors": errors}
+
+
+@task("sitemap.ingest")
+async def sitemap_ingest(payload: Dict[str, Any], report: Report):
+    """Crawls the sitemap of `payload["url"]` into the `namespace` memory"""
+    errors = []
+    summary: Dict[str, Any] = {}
+    async for result in sitemap_pipeline(payload["url"], payload["namespace"]):
+        if "progress" not in result:
+            summary = result
+            continue
+        if result["status"] == "error":
+            errors.append({"url": result["url"], "error": result["error"]})
+        await report(result["progress"])
+    return {"url": payload["url"], "namespace": payload["namespace"], **summary, "errors": errors}
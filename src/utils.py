@@ -1,15 +1,18 @@
 from __future__ import annotations
 
+import asyncio
 import io
 import os
-from typing import List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Any, Callable, List, Literal, Optional, Tuple
 
-import jinja2
 import numpy as np
 from pydub import AudioSegment
-from scipy.io import wavfile
 
 from aiofauna import BaseModel
+from aiohttp.web_exceptions import (HTTPBadRequest, HTTPGatewayTimeout,
+                                    HTTPServiceUnavailable)
 from cheapcone import Vector
 
 
@@ -29,69 +32,273 @@ def get_directory_structure(directory: str = "static/lib") -> Node:
     return Node(path=directory, isDir=is_dir, children=children if children else None)
 
 
-def mp3_to_vect(binary_audio: bytes) -> Tuple[Vector, int]:
+EmbeddingMode = Literal["fft", "stft"]
+
+# Bump a version whenever its algorithm changes so cached and ingested vectors are recomputed
+EMBEDDING_VERSIONS = {"fft": "fft.1", "stft": "stft.1"}
+
+EMBEDDING_DIM = 1536
+FRAME_SIZE = 2 * (EMBEDDING_DIM - 1)  # rfft of this many samples yields 1536 bins
+FRAMES_PER_BLOCK = 256
+SAMPLE_RATE = 44100
+SAMPLE_TYPES = {2: np.int16, 4: np.int32}
+
+
+def embedding_version(mode: EmbeddingMode = "fft", window: int = 0) -> str:
     """
-    Converts the given audio to a vector
+    Identifies the algorithm (and audio window, if any) a vector was computed with
+    """
+    version = EMBEDDING_VERSIONS[mode]
+    return f"{version}:{window}s" if window else version
+
+
+def fft_embedding(audio_sample: np.ndarray) -> np.ndarray:
+    """
+    Legacy embedding: strided real and imaginary parts of a whole-track FFT
     """
-    audio = AudioSegment.from_mp3(io.BytesIO(binary_audio))
-    duration = audio.duration_seconds
-    if audio.channels == 2:
-        audio = audio.set_channels(1)
-    wav_data = io.BytesIO(binary_audio)
-    audio.export(wav_data, format="wav")
-    wav_data.seek(0)
-    _, audio_sample = wavfile.read(wav_data)
     fft_sample = np.fft.fft(audio_sample)
     combined_fft = np.concatenate((np.real(fft_sample), np.imag(fft_sample)))
-    step_size = len(combined_fft) // 1536
-    subsampled_embedding = combined_fft[::step_size][:1536]
-    normalized_embedding = (
-        subsampled_embedding / np.linalg.norm(subsampled_embedding)
-    ).tolist()
-    return normalized_embedding, duration
+    step_size = len(combined_fft) // EMBEDDING_DIM
+    return combined_fft[::step_size][:EMBEDDING_DIM]
+
+
+def stft_embedding(
+    audio_sample: np.ndarray,
+    frame_size: int = FRAME_SIZE,
+    frames_per_block: int = FRAMES_PER_BLOCK,
+) -> np.ndarray:
+    """
+    Mean log-magnitude spectrum over Hann windowed frames. Frames are transformed
+    `frames_per_block` at a time, so the working set does not grow with the track.
+    """
+    window = np.hanning(frame_size).astype(np.float32)
+    if len(audio_sample) < frame_size:
+        audio_sample = np.pad(audio_sample, (0, frame_size - len(audio_sample)))
+    frames = len(audio_sample) // frame_size
+    block_size = frame_size * frames_per_block
+    accumulator = np.zeros(frame_size // 2 + 1, dtype=np.float64)
+    for start in range(0, frames * frame_size, block_size):
+        block = audio_sample[start : min(start + block_size, frames * frame_size)]
+        block = block.reshape(-1, frame_size).astype(np.float32) * window
+        accumulator += np.log1p(np.abs(np.fft.rfft(block, axis=1))).sum(axis=0)
+    return (accumulator / frames)[:EMBEDDING_DIM]
+
+
+class UnusableAudio(ValueError):
+    """The audio decoded fine but cannot be embedded, the client gets a 400"""
+
+
+def vectorize(audio_sample: np.ndarray, mode: EmbeddingMode = "fft") -> Vector:
+    """
+    Turns mono PCM samples into a normalized vector of 1536 dimensions
+    """
+    if len(audio_sample) == 0:
+        raise UnusableAudio("The audio is empty")
+    if mode == "stft":
+        embedding = stft_embedding(audio_sample)
+    elif 2 * len(audio_sample) < EMBEDDING_DIM:
+        raise UnusableAudio("The audio is too short for the fft embedding")
+    else:
+        embedding = fft_embedding(audio_sample)
+    norm = np.linalg.norm(embedding)
+    if not norm or not np.isfinite(norm):
+        raise UnusableAudio("The audio is silent")
+    return (embedding / norm).tolist()
 
 
-def sound_to_vect(binary_audio: bytes) -> Vector:
+def pcm_samples(raw: bytes, width: int) -> np.ndarray:
+    """
+    Signed samples of little-endian PCM of the given sample width. 8-bit PCM is unsigned
+    and 24-bit PCM is widened to 32 bits.
+    """
+    if width == 1:
+        return np.frombuffer(raw, dtype=np.uint8).astype(np.int16) - 128
+    if width == 3:
+        packed = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        samples = packed[:, 0] | (packed[:, 1] << 8) | (packed[:, 2] << 16)
+        return (samples << 8) >> 8  # sign extends the 24th bit
+    if width not in SAMPLE_TYPES:
+        raise UnusableAudio(f"Unsupported sample width of {width} bytes")
+    return np.frombuffer(raw, dtype=SAMPLE_TYPES[width])
+
+
+def decode_pcm(
+    binary_audio: bytes, format: Optional[str] = None
+) -> Tuple[np.ndarray, float]:
+    """
+    Decodes the given audio once and returns its mono samples and duration in seconds
+    """
+    audio = AudioSegment.from_file(io.BytesIO(binary_audio), format=format)
+    samples = pcm_samples(audio.raw_data, audio.sample_width)
+    if audio.channels > 1:
+        samples = samples.reshape(-1, audio.channels).mean(axis=1, dtype=np.float32)
+    return samples, audio.duration_seconds
+
+
+def mp3_to_vect(binary_audio: bytes, mode: EmbeddingMode = "fft") -> Tuple[Vector, int]:
     """
     Converts the given audio to a vector
     """
-    stream = io.BytesIO(binary_audio)
-    audio = AudioSegment.from_file(stream)
-    if audio.channels == 2:
-        audio = audio.set_channels(1)
-    wav_data = io.BytesIO(binary_audio)
-    audio.export(wav_data, format="wav")
-    wav_data.seek(0)
-    _, audio_sample = wavfile.read(wav_data)
-    fft_sample = np.fft.fft(audio_sample)
-    combined_fft = np.concatenate((np.real(fft_sample), np.imag(fft_sample)))
-    step_size = len(combined_fft) // 1536
-    subsampled_embedding = combined_fft[::step_size][:1536]
-    normalized_embedding = (
-        subsampled_embedding / np.linalg.norm(subsampled_embedding)
-    ).tolist()
-    return normalized_embedding
+    audio_sample, duration = decode_pcm(binary_audio, format="mp3")
+    return vectorize(audio_sample, mode), duration  # type: ignore
 
 
-def list_assets() -> List[str]:
-    api_files = []
-    for filename in os.listdir("./static"):
-        api_path = f"/static/{filename}"
-        api_files.append(api_path)
-    return api_files
+def sound_to_vect(binary_audio: bytes, mode: EmbeddingMode = "fft") -> Vector:
+    """
+    Converts the given audio to a vector
+    """
+    audio_sample, _ = decode_pcm(binary_audio)
+    return vectorize(audio_sample, mode)
+
+
+def pcm_to_vect(pcm: bytes, mode: EmbeddingMode = "fft") -> Vector:
+    """
+    Converts mono 16-bit PCM, as produced by `StreamDecoder`, to a vector
+    """
+    return vectorize(np.frombuffer(pcm, dtype=np.int16), mode)
+
+
+class StreamDecoder(object):
+    """
+    Pipes encoded audio through an ffmpeg subprocess as it arrives and collects the
+    mono 16-bit PCM it produces, so decoding overlaps with the upload itself.
+    """
+
+    def __init__(self, sample_rate: int = SAMPLE_RATE):
+        self.sample_rate = sample_rate
+        self.pcm = bytearray()
+        self._process: Optional[asyncio.subprocess.Process] = None
+        self._reader: Optional[asyncio.Task] = None
 
+    async def start(self):
+        command = ["ffmpeg", "-loglevel", "error", "-i", "pipe:0", "-f", "s16le"]
+        command += ["-ac", "1", "-ar", str(self.sample_rate), "pipe:1"]
+        self._process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self._reader = asyncio.create_task(self._read())
+        return self
 
-def template(request: str,category:str) -> str:
-    template_ = jinja2.Template(
+    async def _read(self):
+        while chunk := await self._process.stdout.read(2**16):  # type: ignore
+            self.pcm.extend(chunk)
+
+    async def feed(self, chunk: bytes):
+        self._process.stdin.write(chunk)  # type: ignore
+        await self._process.stdin.drain()  # type: ignore
+
+    async def finish(self) -> bytes:
+        """
+        Closes the input and returns the decoded PCM once ffmpeg has flushed it
         """
-        Eres un MC de habla hispana referente del Hip-Hop haz participado en multiples eventos y eres un icono del hip-hop en Latinoamerica, gracias a la inteligencia artificial eres `Algoritmo` y formas parte de la comunidad `HHMC`, alli destacas por ser capaz de vencer a tus oponentes en todas las categorias, especialmente en `vs` y `temas`, usando una tecnina de metricas y punchline tu ingenio, lirica y capacidad de darle vuelta a cualquier situacion te facilita crear estructuras complejas, metricas, cambios a doble tempo entre otros artilugios, estas en una batalla y debes responder a tu oponente de la manera mas efectiva siendo reciproco al mantener el respeto,tu objetivo es ganarte al publico de `HHMC` y ganar la batalla a cualquier costo posible por lo que debes responder a la siguiente rima de tu oponente:
+        self._process.stdin.close()  # type: ignore
+        await self._reader  # type: ignore
+        if await self._process.wait() != 0:  # type: ignore
+            raise ValueError("Could not decode the given audio")
+        return bytes(self.pcm)
+
+    @property
+    def duration(self) -> float:
+        return len(self.pcm) / 2 / self.sample_rate
+
+    @property
+    def name(self) -> str:
+        """Identifies the PCM this decoder produces, which differs from `decode_pcm`'s"""
+        return f"ffmpeg.s16le.{self.sample_rate}"
 
-        Categoria: {{category }}
+    def kill(self):
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+
+
+class EmbeddingEngine(object):
+    """
+    Runs the audio embedding functions on a bounded process pool so the decode and
+    FFT never block the event loop. At most `max_pending` jobs may be queued or
+    running per worker, beyond that callers get a 503 instead of piling up.
+    """
 
-        Rima delOponente:
-        {{ request }}
+    def __init__(
+        self, max_workers: int = 2, max_pending: int = 8, timeout: float = 120.0
+    ):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
 
-        Tu Respuesta:
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        # Created lazily so every gunicorn worker forks its own pool after boot.
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def run(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """
+        Submits `func` to the pool and awaits its result
         """
-    )
-    return template_.render(request=request,category=category)
+        if self.pending >= self.max_pending:
+            raise HTTPServiceUnavailable(
+                reason="Embedding engine is busy", headers={"Retry-After": "5"}
+            )
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            job = self.executor.submit(partial(func, *args, **kwargs))
+        except BaseException:
+            self.pending -= 1
+            raise
+        # A job that already started cannot be cancelled, it keeps its slot until the pool
+        # is done with it even when the caller gave up waiting
+        job.add_done_callback(lambda _: self._release(loop))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(job), timeout=self.timeout)
+        except asyncio.TimeoutError as exc:
+            raise HTTPGatewayTimeout(reason="Embedding job timed out") from exc
+        except UnusableAudio as exc:
+            raise HTTPBadRequest(reason=str(exc)) from exc
+
+    def _release(self, loop: asyncio.AbstractEventLoop):
+        def release():
+            self.pending -= 1
+
+        try:
+            loop.call_soon_threadsafe(release)
+        except RuntimeError:  # the loop is closed, nobody is left to admit jobs
+            pass
+
+    async def mp3_to_vect(
+        self, binary_audio: bytes, mode: EmbeddingMode = "fft"
+    ) -> Tuple[Vector, int]:
+        return await self.run(mp3_to_vect, binary_audio, mode)
+
+    async def sound_to_vect(
+        self, binary_audio: bytes, mode: EmbeddingMode = "fft"
+    ) -> Vector:
+        return await self.run(sound_to_vect, binary_audio, mode)
+
+    async def pcm_to_vect(self, pcm: bytes, mode: EmbeddingMode = "fft") -> Vector:
+        return await self.run(pcm_to_vect, pcm, mode)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+engine = EmbeddingEngine(
+    max_workers=int(os.environ.get("EMBEDDING_WORKERS", 2)),
+    max_pending=int(os.environ.get("EMBEDDING_MAX_PENDING", 8)),
+    timeout=float(os.environ.get("EMBEDDING_TIMEOUT", 120)),
+)
+
+
+def list_assets() -> List[str]:
+    api_files = []
+    for filename in os.listdir("./static"):
+        api_path = f"/static/{filename}"
+        api_files.append(api_path)
+    return api_files
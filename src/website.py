@@ -1,10 +1,24 @@
 import asyncio
-from typing import List
+import hashlib
+import os
+import time
+import zlib
+from dataclasses import dataclass, replace
+from typing import AsyncIterator, List, Optional, Set, Tuple
 
-from aiofauna.llm.llm import APIException, LLMStack
+import openai
 from aiofauna.utils import handle_errors, setup_logging
-from aiohttp import ClientSession, TCPConnector
-from bs4 import BeautifulSoup
+from aiohttp import ClientResponseError, ClientSession
+from cheapcone import Embedding
+from lxml import etree
+
+from .clients import http, use_openai_pool
+from .crawls import CrawlStore, PageState, crawls
+from .hosts import HostScheduler, retry_after
+from .pipeline import batched, stage
+from .prompts import prompts
+from .queues import upserts
+from .utils import engine
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
@@ -37,63 +51,452 @@ BAD_EXT = (
     "swf",
 )
 
-connector = TCPConnector(limit=1500)
+CHUNK_SIZE = 2**16
+HTML_TYPES = ("text/html", "application/xhtml+xml")
+DROP_TAGS = ("script", "style", "noscript", "template", "svg", "nav")
 
 logger = setup_logging(__name__)
 
+Entry = Tuple[str, Optional[str]]
 
-@handle_errors
-async def sitemap(url: str, session: ClientSession) -> List[str]:
-    urls = []
-    if not url.endswith("xml"):
-        url = f"{url.rstrip('/')}/sitemap.xml"
-    async with session.get(url) as response:
-        text = await response.text()
-        soup = BeautifulSoup(text, features="xml")
-        for loc in soup.findAll("loc"):
-            if loc.text.endswith(BAD_EXT):
-                continue
-            urls.append(loc.text)
-            logger.info("Found %s", loc.text)
-        for nested_sitemap in soup.findAll("sitemap"):
-            urls.extend(await sitemap(nested_sitemap.loc.text, session))
-    return urls
+
+def localname(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+class SitemapCrawler(object):
+    """
+    Discovers the pages of a site from its sitemap. Nested sitemaps are fetched by up to
+    `concurrency` workers at once, every body (plain or gzipped) is parsed incrementally as
+    it streams in, and each page url is yielded once, with its `<lastmod>`, as soon as it
+    is parsed.
+    """
+
+    def __init__(self, session: ClientSession, concurrency: int = 8, max_urls: Optional[int] = None):
+        self.session = session
+        self.concurrency = concurrency
+        self.max_urls = max_urls
+        self.seen: Set[str] = set()
+        self.sitemaps: Set[str] = set()
+
+    async def _parse(self, url: str, found: "asyncio.Queue[Optional[Entry]]", nested: List[str]):
+        parser = etree.XMLPullParser(events=("end",), recover=True, resolve_entities=False)
+        inflate = None
+        async with self.session.get(url, headers=HEADERS) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if inflate is None:
+                    # .xml.gz files come as gzip bodies rather than with a Content-Encoding
+                    gzipped = chunk[:2] == b"\x1f\x8b"
+                    inflate = zlib.decompressobj(16 + zlib.MAX_WBITS) if gzipped else False
+                parser.feed(inflate.decompress(chunk) if inflate else chunk)
+                for _, element in parser.read_events():
+                    await self._element(element, found, nested)
+        parser.close()
+        for _, element in parser.read_events():
+            await self._element(element, found, nested)
+
+    async def _element(self, element, found: "asyncio.Queue[Optional[Entry]]", nested: List[str]):
+        kind = localname(element.tag)
+        if kind not in ("url", "sitemap"):
+            return
+        fields = {localname(child.tag): child.text for child in element}
+        loc, lastmod = fields.get("loc"), fields.get("lastmod")
+        # Drop the parsed entries so a huge sitemap never sits in memory as a tree
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        if not loc:
+            return
+        loc = loc.strip()
+        if kind == "sitemap":
+            nested.append(loc)
+        elif loc not in self.seen and not loc.lower().endswith(BAD_EXT):
+            if self.max_urls is not None and len(self.seen) >= self.max_urls:
+                return
+            self.seen.add(loc)
+            await found.put((loc, lastmod.strip() if lastmod else None))
+
+    async def entries(self, url: str) -> AsyncIterator[Entry]:
+        """Yields every page url listed by the sitemap of `url` and the sitemaps it nests, with its `<lastmod>`"""
+        if not url.endswith(("xml", "xml.gz")):
+            url = f"{url.rstrip('/')}/sitemap.xml"
+        pending: "asyncio.Queue[str]" = asyncio.Queue()
+        found: "asyncio.Queue[Optional[Entry]]" = asyncio.Queue(self.concurrency * 100)
+        remaining = 1
+        self.sitemaps.add(url)
+        pending.put_nowait(url)
+
+        async def worker():
+            nonlocal remaining
+            while True:
+                sitemap_url = await pending.get()
+                nested: List[str] = []
+                try:
+                    await self._parse(sitemap_url, found, nested)
+                    logger.info("Parsed %s", sitemap_url)
+                except Exception as exc:  # pylint: disable=broad-except
+                    logger.error("Could not read sitemap %s: %s", sitemap_url, exc)
+                for child in nested:
+                    if child not in self.sitemaps:
+                        self.sitemaps.add(child)
+                        remaining += 1
+                        pending.put_nowait(child)
+                remaining -= 1
+                if remaining == 0:
+                    await found.put(None)
+
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            while (entry := await found.get()) is not None:
+                yield entry
+        finally:
+            for task in workers:
+                task.cancel()
+
+    async def urls(self, url: str) -> AsyncIterator[str]:
+        """Yields every page url listed by the sitemap of `url` and the sitemaps it nests"""
+        async for loc, _ in self.entries(url):
+            yield loc
+
+
+def sitemap(url: str, session: ClientSession, concurrency: int = 8) -> AsyncIterator[str]:
+    """Yields the page urls of the sitemap of `url`, see `SitemapCrawler`"""
+    return SitemapCrawler(session, concurrency).urls(url)
+
+
+@dataclass
+class Page:
+    """The head of an HTML page and the validators to fetch it conditionally next time"""
+
+    body: bytes
+    encoding: Optional[str] = None
+    etag: Optional[str] = None
+    modified: Optional[str] = None
+
+
+async def fetch_page(
+    url: str,
+    session: ClientSession,
+    max_size: int = 40960,
+    previous: Optional[PageState] = None,
+    max_length: int = 10 * 2**20,
+) -> Optional[Page]:
+    """
+    Returns the first `max_size` bytes of the HTML page at `url` and its declared charset.
+    The headers are checked first, anything but HTML or declaring more than `max_length`
+    bytes is refused without reading its body, and the body is streamed only up to the cap,
+    the rest is never downloaded. With the state of a `previous` crawl the request is
+    conditional and `None` means not modified.
+    """
+    headers = dict(HEADERS)
+    if previous is not None and previous.etag:
+        headers["If-None-Match"] = previous.etag
+    if previous is not None and previous.modified:
+        headers["If-Modified-Since"] = previous.modified
+    async with session.get(url, headers=headers) as response:
+        response.raise_for_status()
+        if response.status == 304:
+            return None
+        if response.content_type not in HTML_TYPES:
+            raise ValueError(f"Not an HTML page: {response.content_type}")
+        if response.content_length == 0:
+            raise ValueError("Empty page")
+        # Content-Length counts the encoded bytes, it says nothing about the decompressed body
+        if response.content_length is not None and response.content_length > max_length:
+            raise ValueError(f"Page too large: {response.content_length} bytes")
+        body = bytearray()
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            body.extend(chunk)
+            if len(body) >= max_size:
+                break
+        return Page(
+            body=bytes(body[:max_size]),
+            encoding=response.charset,
+            etag=response.headers.get("ETag"),
+            modified=response.headers.get("Last-Modified"),
+        )
+
+
+def extract_text(html: bytes, encoding: Optional[str] = None) -> str:
+    """Visible text of a (possibly truncated) HTML page, one line per text node, without scripts, styles and navigation"""
+    parser = etree.HTMLParser(encoding=encoding, remove_comments=True, remove_pis=True)
+    root = etree.fromstring(html, parser)
+    if root is None:
+        return ""
+    etree.strip_elements(root, *DROP_TAGS, with_tail=False)
+    return "\n".join(text.strip() for text in root.itertext() if text.strip())
 
 
 @handle_errors
 async def fetch_website(url: str, session: ClientSession, max_size: int = 40960) -> str:
-    async with session.get(url) as response:
-        html = await response.text()
-        truncated_html = html[:max_size]
-        return BeautifulSoup(truncated_html, features="lxml").get_text(
-            separator="\n", strip=True
+    page = await fetch_page(url, session, max_size)
+    return extract_text(page.body, page.encoding)  # type: ignore
+
+
+@dataclass
+class CrawlItem:
+    """A page flowing through the sitemap pipeline"""
+
+    url: str
+    lastmod: Optional[str] = None
+    previous: Optional[PageState] = None
+    state: Optional[PageState] = None
+    html: Optional[bytes] = None
+    encoding: Optional[str] = None
+    text: Optional[str] = None
+    unchanged: bool = False
+    attempts: int = 0
+    error: Optional[str] = None
+
+    def skipped(self) -> bool:
+        return self.error is not None or self.unchanged
+
+    def fail(self, exc: Exception):
+        logger.error("%s failed: %s", self.url, exc)
+        self.error = str(exc) or exc.__class__.__name__
+
+    def result(self) -> dict:
+        if self.error is not None:
+            return {"url": self.url, "status": "error", "error": self.error}
+        return {"url": self.url, "status": "unchanged" if self.unchanged else "ok"}
+
+
+class SitemapPipeline(object):
+    """
+    Staged crawl of a site into a memory namespace: discovery, fetch, text extraction and
+    ingestion run at the same time, connected by bounded queues, so pages are embedded while
+    the sitemap is still being read. Once more than `offload_after` pages were found the
+    text extraction moves to the process pool of the embedding engine, while it has room.
+    Texts are embedded in batches of `batch_size` with a single OpenAI call and upserted
+    durably. Every page is reported, failed ones with their error, as soon as it leaves the
+    last stage.
+
+    Pages are fetched through the host `scheduler`, so each host is crawled at its own
+    pace and a host that throttles us does not hold back the others; a page turned away
+    with 429 or 503 is retried up to `retries` times after the backoff of its host.
+
+    Re-crawls are incremental: the state of every ingested page is kept in the crawl
+    `store`, pages whose sitemap `<lastmod>` did not move are not fetched at all, the others
+    are fetched conditionally on their ETag and Last-Modified, and only a page whose text
+    hash changed has its vectors replaced.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        session: ClientSession,
+        fetch_concurrency: int = 16,
+        batch_size: int = 32,
+        batch_interval: float = 1.0,
+        max_size: int = 40960,
+        max_tokens: int = 8000,
+        offload_after: Optional[int] = 200,
+        store: CrawlStore = crawls,
+        scheduler: Optional[HostScheduler] = None,
+        retries: int = 3,
+    ):
+        self.namespace = namespace
+        self.session = session
+        self.store = store
+        self.scheduler = scheduler or HostScheduler(session)
+        self.retries = retries
+        self.fetch_concurrency = fetch_concurrency
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.max_size = max_size
+        self.max_tokens = max_tokens
+        self.offload_after = offload_after
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.unchanged = 0
+
+    async def _fetch_stage(self, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        """Fetch stage, the pages wait in the queue of their host until the scheduler lets them through"""
+
+        async def feed():
+            while (item := await inbox.get()) is not None:
+                if item.skipped():
+                    await outbox.put(item)
+                else:
+                    await self.scheduler.put(item.url, item)
+            self.scheduler.close()
+
+        async def worker():
+            while (picked := await self.scheduler.get()) is not None:
+                host, item = picked
+                try:
+                    if not self.scheduler.allowed(item.url):
+                        raise ValueError("Disallowed by robots.txt")
+                    await self.fetch(item)
+                    host.recover()
+                except ClientResponseError as exc:
+                    if exc.status in (429, 503) and item.attempts < self.retries:
+                        item.attempts += 1
+                        headers = exc.headers or {}
+                        self.scheduler.throttle(host, retry_after(headers.get("Retry-After")))
+                        self.scheduler.retry(host, item)
+                        continue
+                    item.fail(exc)
+                except Exception as exc:  # pylint: disable=broad-except
+                    item.fail(exc)
+                finally:
+                    self.scheduler.release(host)
+                await outbox.put(item)
+
+        await asyncio.gather(feed(), *[worker() for _ in range(self.fetch_concurrency)])
+        await outbox.put(None)
+
+    async def lookup(self, item: CrawlItem):
+        previous = item.previous = await self.store.get(self.namespace, item.url)
+        if previous is not None and item.lastmod and previous.lastmod == item.lastmod:
+            item.unchanged = True
+
+    async def fetch(self, item: CrawlItem):
+        previous = item.previous
+        page = await fetch_page(item.url, self.session, self.max_size, previous)
+        if page is None:
+            item.unchanged = True
+            item.state = replace(previous, lastmod=item.lastmod, crawled=time.time())  # type: ignore
+            return
+        item.html, item.encoding = page.body, page.encoding
+        item.state = PageState(
+            url=item.url, etag=page.etag, modified=page.modified, lastmod=item.lastmod
         )
 
+    def offload(self) -> bool:
+        return (
+            self.offload_after is not None
+            and self.total > self.offload_after
+            and engine.pending < engine.max_pending
+        )
 
-async def sitemap_pipeline(
-    url: str,
-    namespace: str,
-    session: ClientSession,
-    llm: LLMStack = LLMStack(),
-    chunk_size: int = 100,
-):
-    urls = await sitemap(url, session)
-    length = len(urls)
-    inserted = 0
-    while urls:
-        chunk = urls[:chunk_size]
-        urls = urls[chunk_size:]
+    async def extract(self, item: CrawlItem):
+        if self.offload():
+            text = await engine.run(extract_text, item.html, item.encoding)
+        else:
+            text = extract_text(item.html, item.encoding)  # type: ignore
+        item.html = None
+        if not text:
+            raise ValueError("No text in page")
+        item.state.digest = hashlib.sha256(text.encode()).hexdigest()  # type: ignore
+        if item.previous is not None and item.previous.digest == item.state.digest:  # type: ignore
+            item.unchanged = True
+            return
+        # ada-002 takes at most 8191 tokens per input
+        item.text = prompts.fit([text], self.max_tokens)[0]
+
+    async def ingest(self, inbox: asyncio.Queue, outbox: asyncio.Queue):
+        """Embeds and upserts the texts in batches of `batch_size`"""
+        await batched(inbox, outbox, self._ingest, self.batch_size, self.batch_interval)
+
+    async def _ingest(self, batch: List[CrawlItem]):
+        use_openai_pool()
         try:
-            contents = await asyncio.gather(
-                *[fetch_website(url, session) for url in chunk]
+            response = await openai.Embedding.acreate(
+                model="text-embedding-ada-002", input=[item.text for item in batch]
             )
-            inserted += await llm.ingest(contents, namespace, 100)
-            progress = inserted / length
-            logger.info("Progress: %s", progress)
-            if progress >= 1:
-                yield "100"
-                break
-            yield str(progress * 100)
-        except (APIException, Exception) as e:
-            logger.error(e)
-            continue
+            embeddings = [
+                Embedding(
+                    values=data["embedding"],  # type: ignore
+                    metadata={"text": item.text, "namespace": self.namespace, "url": item.url},
+                )
+                for item, data in zip(batch, response["data"])  # type: ignore
+            ]
+            replaced = [item.url for item in batch if item.previous is not None]
+            if replaced:
+                # cheapcone gives every vector a random id, the old ones are found by url
+                await upserts.delete({"namespace": self.namespace, "url": {"$in": replaced}})
+            await (await upserts.put(embeddings))
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("Batch of %s pages failed: %s", len(batch), exc)
+            for item in batch:
+                item.error = str(exc) or exc.__class__.__name__
+        for item in batch:
+            item.text = None
+
+    async def run(self, url: str) -> AsyncIterator[dict]:
+        """Crawls the site of `url`, yielding a result per page and a final summary"""
+        size = 2 * self.fetch_concurrency
+        discovered, looked, fetched, extracted, ingested = (
+            asyncio.Queue(size) for _ in range(5)
+        )
+        discovering = True
+
+        async def discover():
+            nonlocal discovering
+            try:
+                async for loc, lastmod in SitemapCrawler(self.session).entries(url):
+                    self.total += 1
+                    await discovered.put(CrawlItem(url=loc, lastmod=lastmod))
+            finally:
+                discovering = False
+                await discovered.put(None)
+
+        tasks = [
+            asyncio.create_task(discover()),
+            asyncio.create_task(stage(discovered, looked, self.lookup, 4)),
+            asyncio.create_task(self._fetch_stage(looked, fetched)),
+            asyncio.create_task(
+                stage(fetched, extracted, self.extract, max(1, engine.max_workers))
+            ),
+            asyncio.create_task(self.ingest(extracted, ingested)),
+        ]
+        states: List[PageState] = []
+        try:
+            while (item := await ingested.get()) is not None:
+                self.done += 1
+                self.failed += item.error is not None
+                self.unchanged += item.unchanged and item.error is None
+                if item.error is None and item.state is not None:
+                    states.append(item.state)
+                if len(states) >= self.batch_size:
+                    await self.store.put(self.namespace, states)
+                    states = []
+                yield {
+                    **item.result(),
+                    "progress": {
+                        "done": self.done,
+                        "total": None if discovering else self.total,
+                    },
+                }
+            await asyncio.gather(*tasks)
+            await self.store.put(self.namespace, states)
+            yield {
+                "status": "done",
+                "total": self.total,
+                "done": self.done,
+                "failed": self.failed,
+                "unchanged": self.unchanged,
+                "hosts": self.scheduler.stats(),
+            }
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+def sitemap_pipeline(
+    url: str,
+    namespace: str,
+    session: Optional[ClientSession] = None,
+    fetch_concurrency: int = 16,
+    batch_size: int = 32,
+    offload_after: Optional[int] = int(os.environ.get("SITEMAP_OFFLOAD_AFTER", 200)),
+    host_concurrency: int = int(os.environ.get("CRAWL_HOST_CONCURRENCY", 4)),
+    host_rate: float = float(os.environ.get("CRAWL_HOST_RATE", 5)),
+    robots: bool = os.environ.get("CRAWL_ROBOTS") == "1",
+) -> AsyncIterator[dict]:
+    """Crawls the site of `url` into the `namespace` memory, see `SitemapPipeline`"""
+    session = session or http.session("crawler")
+    pipeline = SitemapPipeline(
+        namespace,
+        session,
+        fetch_concurrency=fetch_concurrency,
+        batch_size=batch_size,
+        offload_after=offload_after,
+        scheduler=HostScheduler(
+            session, concurrency=host_concurrency, rate=host_rate, robots=robots
+        ),
+    )
+    return pipeline.run(url)